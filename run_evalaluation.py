@@ -1,4 +1,6 @@
-from twapy import Evaluation, score_evaluation_file
+from twapy import Evaluation, configure_logging, score_evaluation_file
+
+configure_logging()
 
 evals_fn = "groundtruth.csv"
 models_dir = "models"
@@ -7,6 +7,7 @@ be 'cilnton').
 
 import twapy
 
+twapy.configure_logging()
 model_dir = './models'
 collection = twapy.ModelCollection(model_dir)
 analogy = twapy.Analogy('reagan', '1987', '1997', collection=collection)
@@ -50,34 +50,81 @@ __author__ = 'Terrence Szymanski'
 __verion__ = '0.1'
 __date__ = '2017-07-30'
 
+import importlib
 import logging
 
 ###############################################################################
 # LOGGING
 #
-# Configure logging. This is currently configured in a very simplistic
-# way but it should be done better. All submodules should just import
-# the logging functions from here, to enable a centralized
-# configuration. (e.g. `from twapy import error, warn, info, debug`)
+# All submodules should just import the logging functions from here, to
+# enable a centralized configuration. (e.g. `from twapy import error, warn,
+# info, debug`). Importing twapy does not configure logging: applications
+# and scripts call `configure_logging` (or configure the `twapy` logger
+# themselves) to see the messages.
+#
+# The logging functions take a message and optionally arguments to format it with, e.g.
+# `debug("Loaded {:,} words from {:}", n, filename)`.
 ###############################################################################
 
 logfile = None  # Change this to log to a file instead of the console
 loglevel = 'DEBUG'  # Change this if desired. loglevel = 100 will disable logging
 logger = logging.getLogger(__name__)
-logging.basicConfig(filename=logfile, level=loglevel)
+logger.addHandler(logging.NullHandler())
 log = logger.log
-error = logger.error
-warn = logger.warn
-info = logger.info
-debug = logger.debug
+
+
+def configure_logging(filename=None, level=None):
+    """Configure logging for scripts, by default with `logfile` and `loglevel`."""
+    logging.basicConfig(filename=logfile if filename is None else filename,
+                        level=loglevel if level is None else level)
+    return
+
+
+def _log_function(level):
+    """Return a function that logs a message at `level`. The message is only formatted (with
+    `str.format` and the remaining arguments) if the level is enabled, so that disabled log calls
+    are cheap."""
+    def log_message(msg, *args):
+        if logger.isEnabledFor(level):
+            logger.log(level, msg.format(*args) if args else msg)
+    return log_message
+
+
+error = _log_function(logging.ERROR)
+warn = _log_function(logging.WARNING)
+info = _log_function(logging.INFO)
+debug = _log_function(logging.DEBUG)
 
 
 ###############################################################################
 # Top-level imports
 #
-# All of the `twapy` methods to be available via top-level imports
+# All of the `twapy` methods to be available via top-level imports. The
+# submodules (and numpy, gensim, pandas, etc.) are only imported when one of
+# these names is first used, so that `import twapy` is fast.
 ###############################################################################
 
-from .models import ModelCollection, VectorSpaceModel
-from .alignment import Alignment, Analogy
-from .evaluate import Evaluation, score_evaluation_file
+_exports = {
+    "ModelCollection": "models",
+    "VectorSpaceModel": "models",
+    "Alignment": "alignment",
+    "AlignmentRegistry": "alignment",
+    "AlignmentStore": "alignment",
+    "Analogy": "alignment",
+    "Evaluation": "evaluate",
+    "score_evaluation": "evaluate",
+    "score_evaluation_file": "evaluate",
+}
+
+
+def __getattr__(name):
+    if name in _exports:
+        module = importlib.import_module("." + _exports[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
@@ -2,7 +2,8 @@
 analogies.
 
 The `Alignment` class takes two models and fits a linear regression transformation between them,
-and also applies this transformation to produce a third model.
+and also applies this transformation to produce a third model. The third model is an
+`AlignedModel`, which transforms the vectors of the first model on demand.
 
 The `Analogy` class solves a temporal word analogy. Its inputs are the LHS word, the LHS model,
 and the RHS model, and its output is the RHS word. In its implementation, an `Analogy` must have
@@ -16,15 +17,25 @@ An example of how to use these classes to solve a temporal word analogy is:
 >>> print(a.analogy('reagan'))
 1987 : reagan :: 1997 : clinton
 
+Fitting the regression between two models is expensive, so fitted transformations can be saved
+in an `AlignmentStore` and reused the next time the same pair of models is aligned:
+
+>>> from twapy.alignment import AlignmentStore
+>>> store = AlignmentStore('/path/to/alignments')
+>>> a = Alignment('/path/to/models/1987.bin', '/path/to/models/1997.bin', store=store, seed=0)
+
 """
 
-import random
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
 import numpy as np
-from sklearn.linear_model import LinearRegression
-from gensim.models import KeyedVectors
-# from gensim.models import Word2Vec
-from . import VectorSpaceModel
+from .models import VectorSpaceModel, _import_gensim, norm_filename
+from .tables import AnalogyTable, precompute
 from . import error, warn, info, debug
+from . import metrics
 
 
 
@@ -36,12 +47,23 @@ class Alignment(object):
 
     """
 
-    def __init__(self, model1, model2, collection=None, samplesize=0.5):
+    def __init__(self, model1, model2, collection=None, samplesize=0.5, seed=None, store=None,
+                 solver="lstsq", regression=None):
         """There are three ways to initialize an `Alignment`:
         1) With two VectorSpaceModel instances
         2) With two filenames (which can be loaded to VectorSpaceModel instances)
         3) With two model names and a ModelCollection instance
+
+        `seed` seeds the sampling of the words used to fit the regression, and `solver` selects
+        how the regression is solved (see `fit_w2v_regression`). If an `AlignmentStore`
+        is given as `store`, a previously fitted transformation is loaded from it instead of
+        being refit, and new fits are saved to it. If a transformation is given as `regression`,
+        it is used as it is and nothing is fitted.
+
+        If the store has a precomputed `AnalogyTable` for the alignment (see `precompute`), it is
+        loaded as `table`, and analogies of the words in the table are looked up in it.
         """
+        self.collection = collection
         if collection is not None:
             self.model1 = collection[model1]
             self.model2 = collection[model2]
@@ -57,9 +79,16 @@ class Alignment(object):
         self.model3 = None
         self.name = "{:}->{:}".format(self.model1.name, self.model2.name)
         self.samplesize = samplesize
-        self.regression = None
-        debug("Initialized {:}".format(self))
-        self.fit_transform()
+        self.seed = seed
+        self.solver = solver
+        self.store = store
+        self.regression = regression
+        self.table = None
+        debug("Initialized {:}", self)
+        if regression is None:
+            self.fit_transform()
+        else:
+            self.model3 = AlignedModel(self.model1, regression, name=self.name)
         return
 
     def __repr__(self):
@@ -79,13 +108,44 @@ class Alignment(object):
     #
     def fit_transform(self):
         """Fit the regression that aligns model1 and model2."""
-        debug("Fitting regression from '{:}' to '{:}'".format(self.model1.name, self.model2.name))
-        self.regression = fit_w2v_regression(self.model1.m, self.model2.m, self.samplesize)
-        debug("Applying transformation {:}".format(self.name))
-        self.model3 = VectorSpaceModel(name=self.name)
-        self.model3.m = apply_wv2_regression(self.model1.m, self.regression)
+        self.regression = None
+        if self.store is not None:
+            self.regression = self.store.load(self.model1, self.model2, self.samplesize, self.seed,
+                                              self.solver)
+        if self.regression is None:
+            debug("Fitting regression from '{:}' to '{:}'", self.model1.name, self.model2.name)
+            rows = None
+            if self.collection is not None:
+                # Use the global vocabulary of the collection to find the common words.
+                rows = self.collection.common_rows(self.model1.name, self.model2.name)
+            self.regression = fit_w2v_regression(self.model1, self.model2, self.samplesize,
+                                                 seed=self.seed, solver=self.solver, rows=rows)
+            if self.store is not None:
+                self.store.save(self.regression, self.model1, self.model2, self.samplesize,
+                                self.seed, self.solver)
+        self.model3 = AlignedModel(self.model1, self.regression, name=self.name)
+        if self.store is not None:
+            self.store.attach(self.model3, self.model1, self.model2, self.samplesize, self.seed,
+                              self.solver)
+            self.table = self.store.load_table(self.model1, self.model2, self.samplesize,
+                                               self.seed, self.solver)
         return
 
+    def precompute(self, words, topn=10, blocksize=1024, workers=1, dirname=None):
+        """Precompute the `topn` analogues of `words` (a list of words, or a number `k` for the
+        first `k` words of model1) and save them as an `AnalogyTable` (see `twapy.tables`), which
+        is then used by this alignment. The table is saved in the store, unless `dirname` is
+        given."""
+        if dirname is None:
+            if self.store is None:
+                raise ValueError("Alignment {:} has no store to save the table in.".format(
+                    self.name))
+            dirname = self.store.table_dirname(self.model1, self.model2, self.samplesize,
+                                               self.seed, self.solver)
+        self.table = precompute(self, words, dirname, topn=topn, blocksize=blocksize,
+                                workers=workers)
+        return self.table
+
     def compare_nns(self, word, topn=10, allow_keyerror=True):
         """This function will return a three-tuple of the lists of the topn nearest neighbors to
         the given word in each of the three alignment models."""
@@ -115,6 +175,44 @@ class Alignment(object):
     def analogy(self, word):
         return Analogy(word1=word, alignment=self)
 
+    def analogies(self, words, topn=1, allow_keyerror=True, use_table=True):
+        """Solve the analogies for a list of words in one pass.
+
+        The vectors of all the words are transformed with a single matrix product and compared to
+        the normalised vectors of model2 with another. Returns a list with one item per word: the
+        list of the `topn` `(word, similarity)` analogues in model2, or None if the word is not in
+        the vocabulary of model1 (if `allow_keyerror` is False, a KeyError is raised instead).
+
+        Words in the precomputed `table` (if there is one, `use_table` is True and the table has
+        at least `topn` analogues per word) are looked up in it instead.
+        """
+        vocab = self.model1.vocab
+        table = self.table if use_table and self.table is not None else None
+        if table is not None and topn > table.topn:
+            table = None
+        results = [None] * len(words)
+        rows = []
+        found = []
+        for i, word in enumerate(words):
+            if table is not None:
+                results[i] = table.lookup(word, topn)
+                if results[i] is not None:
+                    continue
+            row = vocab.get(word) if isinstance(word, str) else None
+            if row is None:
+                if not allow_keyerror:
+                    raise KeyError("word '{:}' not in vocabulary".format(word))
+                continue
+            rows.append(row)
+            found.append(i)
+        if not rows:
+            return results
+        debug("Solving {:,} analogies with {:}", len(rows), self.name)
+        vectors = self.model3.transform_vectors(self.model1.syn0[rows])
+        for i, neighbors in zip(found, self.model2.similar_by_vectors(vectors, topn=topn)):
+            results[i] = neighbors
+        return results
+
     def print_analogy(self, word):
         result = self.analogy(word)
         print("{:>10s} : {:>20s} <=> {:<20s} : {:<10s}".format(
@@ -138,14 +236,385 @@ class Alignment(object):
         print(s)
 
 
+class AlignedModel(VectorSpaceModel):
+
+    """A lazy view of a model with a transformation applied to its vectors.
+
+    The view shares the vocabulary and row index of the underlying model. Single vectors
+    (`model[word]`) and batches of vectors (`transform(words)`) are transformed on demand, and the
+    full transformed matrix (`syn0`) is only computed, and then kept, when an operation needs it,
+    such as a nearest-neighbour search over the aligned model.
+
+    """
+
+    def __init__(self, model, regression, name=None):
+        self.model = model
+        self.regression = regression
+        super(AlignedModel, self).__init__(name=name, index2word=model.index2word)
+        return
+
+    @property
+    def syn0(self):
+        if self._syn0 is None and self.model.syn0 is not None:
+            debug("Transforming {:,} vectors of {:}", len(self.model), self.name)
+            self._syn0 = self.transform_vectors(self.model.syn0)
+        return self._syn0
+
+    @syn0.setter
+    def syn0(self, syn0):
+        self._syn0 = syn0
+        return
+
+    @property
+    def vocab(self):
+        return self.model.vocab
+
+    @property
+    def nbytes(self):
+        nbytes = 0
+        for matrix in (self._syn0, self._syn0norm):
+            if matrix is not None and not isinstance(matrix, np.memmap):
+                nbytes += matrix.nbytes
+        return nbytes
+
+    @property
+    def vector_size(self):
+        return self.regression.coef_.shape[0]
+
+    @metrics.timed("transform")
+    def transform_vectors(self, vectors):
+        """Apply the transformation to a vector or a matrix of row vectors."""
+        vectors = np.asarray(vectors)
+        if vectors.ndim == 1:
+            return self._predict(vectors[np.newaxis, :])[0]
+        return self._predict(vectors)
+
+    def _predict(self, vectors):
+        return np.asarray(self.regression.predict(vectors), dtype=np.float32)
+
+    def transform(self, words):
+        """Return the matrix of transformed vectors for a list of words."""
+        vocab = self.vocab
+        rows = [vocab[word] for word in words]
+        if self._syn0 is not None:
+            return self._syn0[rows]
+        return self.transform_vectors(self.model.syn0[rows])
+
+    def __getitem__(self, word):
+        if self._syn0 is not None:
+            return self._syn0[self.vocab[word]]
+        return self.transform_vectors(self.model[word])
+
+    def __len__(self):
+        return len(self.index2word)
+
+    def __repr__(self):
+        return "<AlignedModel {:} with {:,} vectors>".format(repr(self.name), len(self))
+
+
+class LinearTransform(object):
+
+    """A fitted linear transformation `y = x . coef_^T + intercept_`.
+
+    This has the same `coef_`, `intercept_` and `predict` interface as sklearn's
+    `LinearRegression`. It is returned by `fit_w2v_regression` and by `AlignmentStore.load`.
+
+    """
+
+    def __init__(self, coef, intercept):
+        self.coef_ = coef
+        self.intercept_ = intercept
+        return
+
+    def predict(self, X):
+        return np.dot(X, self.coef_.T) + self.intercept_
+
+    def __repr__(self):
+        return "<LinearTransform {:d} -> {:d}>".format(self.coef_.shape[1], self.coef_.shape[0])
+
+
+class AlignmentStore(object):
+
+    """A directory of fitted alignment transformations.
+
+    Each transformation is saved as a `.npz` file holding the coefficient matrix and intercept of
+    the regression. Files are keyed by the identity of both models (their names and content
+    fingerprints), the sample size, the random seed and the solver, so a transformation is only
+    reused for exactly the same fit.
+
+    The transformed vectors of an aligned model (and their normalised vectors) can be saved too,
+    with `save_aligned`. Alignments that use the store then memory-map them instead of computing
+    them, so processes that share the store also share the pages of the aligned models.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return
+
+    def key(self, model1, model2, samplesize, seed, solver="lstsq"):
+        """Return the key that identifies the fit of `model1` onto `model2`."""
+        ident = repr((model1.name, model1.fingerprint, model2.name, model2.fingerprint,
+                      samplesize, seed, solver))
+        return hashlib.sha1(ident.encode("utf-8")).hexdigest()
+
+    def filename(self, model1, model2, samplesize, seed, solver="lstsq"):
+        return os.path.join(self.directory, "{:}_{:}_{:}.npz".format(
+            model1.name, model2.name, self.key(model1, model2, samplesize, seed, solver)[:16]))
+
+    def load(self, model1, model2, samplesize, seed=None, solver="lstsq"):
+        """Return the stored transformation of `model1` onto `model2`, or None if there is none."""
+        fn = self.filename(model1, model2, samplesize, seed, solver)
+        if not os.path.exists(fn):
+            return None
+        debug("Loading alignment from file {:}", fn)
+        with np.load(fn) as data:
+            return LinearTransform(data["coef"], data["intercept"])
+
+    def table_dirname(self, model1, model2, samplesize, seed, solver="lstsq"):
+        """Return the directory of the `AnalogyTable` of the alignment of `model1` onto `model2`.
+        The analogues in a table depend on the words of model2 that are searched, so tables for
+        a model2 with `restrict_vocab` set are kept apart."""
+        stem = os.path.splitext(self.filename(model1, model2, samplesize, seed, solver))[0]
+        restrict_vocab = getattr(model2, "restrict_vocab", None)
+        if restrict_vocab is not None:
+            stem += "_restrict{:d}".format(restrict_vocab)
+        return stem + ".table"
+
+    def load_table(self, model1, model2, samplesize, seed=None, solver="lstsq"):
+        """Return the precomputed `AnalogyTable` of the alignment of `model1` onto `model2`, or
+        None if there is none."""
+        dirname = self.table_dirname(model1, model2, samplesize, seed, solver)
+        if not os.path.isdir(dirname):
+            return None
+        table = AnalogyTable.load(dirname, model1, model2)
+        if table.slots.shape[0] != len(model1):
+            return None
+        return table
+
+    def aligned_filename(self, model1, model2, samplesize, seed, solver="lstsq"):
+        return os.path.splitext(self.filename(model1, model2, samplesize, seed, solver))[0] + ".npy"
+
+    def save_aligned(self, aligned, model1, model2, samplesize, seed=None, solver="lstsq"):
+        """Save the transformed vectors, and their normalised vectors, of the `AlignedModel` of
+        `model1` onto `model2`."""
+        fn = self.aligned_filename(model1, model2, samplesize, seed, solver)
+        debug("Saving aligned vectors to file {:}", fn)
+        for filename, matrix in ((fn, aligned.syn0), (norm_filename(fn), aligned.syn0norm)):
+            fd, tmp = tempfile.mkstemp(suffix=".npy", dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.ascontiguousarray(matrix, dtype=np.float32))
+            os.replace(tmp, filename)
+        return fn
+
+    def attach(self, aligned, model1, model2, samplesize, seed=None, solver="lstsq"):
+        """Memory-map the saved vectors of the `AlignedModel` of `model1` onto `model2`, if they
+        have been saved with `save_aligned`.
+
+        ::returns:: True if the vectors were attached.
+        """
+        fn = self.aligned_filename(model1, model2, samplesize, seed, solver)
+        if not os.path.exists(fn) or not os.path.exists(norm_filename(fn)):
+            return False
+        syn0 = np.load(fn, mmap_mode="r")
+        if syn0.shape[0] != len(aligned):
+            return False
+        debug("Attaching aligned vectors from file {:}", fn)
+        aligned.syn0 = syn0
+        aligned.syn0norm = np.load(norm_filename(fn), mmap_mode="r")
+        return True
+
+    def save(self, regression, model1, model2, samplesize, seed=None, solver="lstsq"):
+        """Save the fitted `regression` of `model1` onto `model2`."""
+        fn = self.filename(model1, model2, samplesize, seed, solver)
+        debug("Saving alignment to file {:}", fn)
+        # Write to a temporary file first so that readers never see a partial file.
+        fd, tmp = tempfile.mkstemp(suffix=".npz", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, coef=np.asarray(regression.coef_, dtype=np.float32),
+                     intercept=np.asarray(regression.intercept_, dtype=np.float32))
+        os.replace(tmp, fn)
+        return fn
+
+    def __repr__(self):
+        return "<AlignmentStore {:}>".format(repr(self.directory))
+
+
+class AnchorSpace(object):
+
+    """Alignments between any pair of models of a collection, through a shared reference space.
+
+    Instead of fitting a transformation for every ordered pair of models, each model is aligned
+    once onto a `reference` model (by default, the middle model of the collection), so a
+    collection of N models needs N-1 fits instead of N*(N-1). `alignment(a, b)` then returns an
+    `Alignment` of `a` onto `b` in one of two ways:
+
+     * by composing the transformation of `a` onto the reference with the inverse of the
+       transformation of `b` onto the reference (the default), or
+     * with `shared=True`, by comparing in the reference space directly: `a` is transformed into
+       the reference space and compared with all of `b` transformed into the reference space.
+       This keeps a transformed copy of the vectors of each target model.
+
+    The remaining arguments are passed to `Alignment` for the fits onto the reference.
+
+    """
+
+    def __init__(self, collection, reference=None, samplesize=0.5, seed=None, store=None,
+                 solver="lstsq"):
+        self.collection = collection
+        if reference is None:
+            modelnames = collection.modelnames
+            reference = modelnames[len(modelnames) // 2]
+        self.reference = reference
+        self.samplesize = samplesize
+        self.seed = seed
+        self.store = store
+        self.solver = solver
+        self._transforms = {}
+        self._shared = {}
+        self._lock = threading.Lock()
+        return
+
+    def transform(self, modelname):
+        """Return the transformation of `modelname` onto the reference space."""
+        with self._lock:
+            if modelname not in self._transforms:
+                if modelname == self.reference:
+                    d = self.collection[modelname].vector_size
+                    transform = LinearTransform(np.eye(d, dtype=np.float32),
+                                                np.zeros(d, dtype=np.float32))
+                else:
+                    transform = Alignment(modelname, self.reference, collection=self.collection,
+                                          samplesize=self.samplesize, seed=self.seed,
+                                          store=self.store, solver=self.solver).regression
+                self._transforms[modelname] = transform
+            return self._transforms[modelname]
+
+    def compose(self, modelname1, modelname2):
+        """Return the transformation of `modelname1` onto `modelname2` through the reference."""
+        t1 = self.transform(modelname1)
+        t2 = self.transform(modelname2)
+        inverse = np.linalg.pinv(np.asarray(t2.coef_, dtype=np.float32))
+        coef = np.dot(inverse, t1.coef_).astype(np.float32)
+        intercept = np.dot(inverse, t1.intercept_ - t2.intercept_).astype(np.float32)
+        return LinearTransform(coef, intercept)
+
+    def shared_model(self, modelname):
+        """Return `modelname` transformed into the reference space."""
+        if modelname not in self._shared:
+            self._shared[modelname] = AlignedModel(self.collection[modelname],
+                                                   self.transform(modelname),
+                                                   name="{:}->{:}".format(modelname, self.reference))
+        return self._shared[modelname]
+
+    def alignment(self, modelname1, modelname2, shared=False):
+        """Return an `Alignment` of `modelname1` onto `modelname2` through the reference space."""
+        model1 = self.collection[modelname1]
+        if shared:
+            return Alignment(model1, self.shared_model(modelname2),
+                             regression=self.transform(modelname1))
+        return Alignment(model1, self.collection[modelname2],
+                         regression=self.compose(modelname1, modelname2))
+
+    def __repr__(self):
+        return "<AnchorSpace with reference {:} and {:d} fits>".format(
+            repr(self.reference), len(self._transforms))
+
+
+class AlignmentRegistry(object):
+
+    """A thread-safe registry of alignments between the models of a `ModelCollection`.
+
+    `get` returns the alignment of two models, building it the first time it is requested.
+    Concurrent requests for an alignment that is being built wait for that build instead of
+    starting their own, so each alignment is only built once. At most `maxsize` alignments are
+    kept (None for no limit), and the least recently used ones are dropped first.
+
+    The remaining arguments are passed to `Alignment`.
+
+    """
+
+    def __init__(self, collection, samplesize=0.5, seed=None, store=None, solver="lstsq",
+                 maxsize=None):
+        self.collection = collection
+        self.samplesize = samplesize
+        self.seed = seed
+        self.store = store
+        self.solver = solver
+        self.maxsize = maxsize
+        self._alignments = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+        return
+
+    def get(self, modelname1, modelname2):
+        """Return the alignment of `modelname1` onto `modelname2`."""
+        key = (modelname1, modelname2)
+        while True:
+            with self._lock:
+                alignment = self._alignments.get(key)
+                if alignment is not None:
+                    self._alignments.move_to_end(key)
+                    return alignment
+                event = self._building.get(key)
+                building = event is None
+                if building:
+                    event = self._building[key] = threading.Event()
+            if building:
+                break
+            # Another thread is building this alignment. Wait for it, then look again (if the
+            # build failed, this thread will try to build it instead).
+            event.wait()
+        try:
+            alignment = Alignment(modelname1, modelname2, collection=self.collection,
+                                  samplesize=self.samplesize, seed=self.seed, store=self.store,
+                                  solver=self.solver)
+            with self._lock:
+                self._alignments[key] = alignment
+                while self.maxsize is not None and len(self._alignments) > self.maxsize:
+                    self._alignments.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._building[key]
+            event.set()
+        return alignment
+
+    def discard(self, modelname):
+        """Drop the alignments from or onto the model `modelname` (e.g. when its file has
+        changed)."""
+        with self._lock:
+            for key in [key for key in self._alignments if modelname in key]:
+                del self._alignments[key]
+        return
+
+    def preload(self, pairs):
+        """Build the alignments for a list of `(modelname1, modelname2)` pairs."""
+        for modelname1, modelname2 in pairs:
+            info("Preloading alignment {:}->{:}", modelname1, modelname2)
+            self.get(modelname1, modelname2)
+        return
+
+    def __contains__(self, key):
+        return tuple(key) in self._alignments
+
+    def __len__(self):
+        return len(self._alignments)
+
+    def __repr__(self):
+        return "<AlignmentRegistry with {:d} alignments>".format(len(self))
+
+
 class Analogy(object):
 
     """An analogy is.... An analogy requires an alignment. If on is not passed to the
     constructor, then an `Alignment` will be created. """
 
-    def __init__(self, word1, model1=None, model2=None, collection=None, alignment=None):
+    def __init__(self, word1, model1=None, model2=None, collection=None, alignment=None,
+                 store=None):
         if alignment is None:
-            self.alignment = Alignment(model1, model2, collection)
+            self.alignment = Alignment(model1, model2, collection, store=store)
         else:
             self.alignment = alignment
         self.word1 = word1
@@ -154,14 +623,26 @@ class Analogy(object):
         return
 
     def solve(self):
+        """Find the analogue of `word1`, from the precomputed table of the alignment if it has the
+        word, and otherwise with a nearest-neighbour search."""
         debug("Solving analogy...")
-        vec1 = self.alignment.model1[self.word1]
-        vec3 = self.alignment.model3[self.word1]
-        self.neighbors1 = self.alignment.model1.most_similar(vec1)
-        self.neighbors2 = self.alignment.model2.most_similar(vec3)
+        self._neighbors1 = None
+        table = self.alignment.table
+        self.neighbors2 = table.lookup(self.word1, 5) if table is not None else None
+        if self.neighbors2 is None:
+            vec3 = self.alignment.model3[self.word1]
+            self.neighbors2 = self.alignment.model2.most_similar(vec3)
         self.word2 = self.neighbors2[0][0]
         return
 
+    @property
+    def neighbors1(self):
+        """The nearest neighbours of `word1` in model1, found when they are first needed."""
+        if self._neighbors1 is None:
+            self._neighbors1 = self.alignment.model1.most_similar(
+                self.alignment.model1[self.word1])
+        return self._neighbors1
+
     def __str__(self):
         return "{:} : {:} :: {:} : {:}".format(self.alignment.model1.name, self.word1,
                                                self.alignment.model2.name, self.word2)
@@ -170,39 +651,89 @@ class Analogy(object):
         return "<Analogy {:} {:}->{:}>".format(repr(self.word1), self.model1.name, self.model2.name)
 
 
-def fit_w2v_regression(model1, model2, samplesize=0.5):
-    """Given two gensim Word2Vec models, fit a regression model using a subset of the vocabulary.
+@metrics.timed("common_vocab")
+def common_rows(model1, model2):
+    """Find the words that two models have in common.
+
+    ::param model1:: a `VectorSpaceModel` or gensim `KeyedVectors` instance for the LHS
+    ::param model2:: a `VectorSpaceModel` or gensim `KeyedVectors` instance for the RHS
+    ::returns:: a tuple `(rows1, rows2)` of integer arrays with the rows of the common words in
+        each model (sorted by word). The end-of-sentence token `</s>` is left out.
+    """
+    vocab1, vocab2 = model1.vocab, model2.vocab
+    common = sorted(word for word in vocab1 if word in vocab2 and word != "</s>")
+    # Gensim vocabularies map words to `Vocab` objects rather than to rows.
+    rows1 = np.fromiter((getattr(vocab1[word], "index", vocab1[word]) for word in common),
+                        dtype=np.int64, count=len(common))
+    rows2 = np.fromiter((getattr(vocab2[word], "index", vocab2[word]) for word in common),
+                        dtype=np.int64, count=len(common))
+    return rows1, rows2
+
+
+def fit_w2v_regression(model1, model2, samplesize=0.5, seed=None, solver="lstsq", rows=None):
+    """Given two models, fit a regression model using a subset of the vocabulary.
     The size of this subset is given by the samplesize parameter, which can specify either a
     percentage of the common vocab to use, or the number of words to use.
 
-    ::param model1:: a gensim `KeyedVectors` instance for the LHS
-    ::param model2:: a gensim `KeyedVectors` instance for the RHS
+    The sample is drawn as an array of row indices and the vectors are gathered from `syn0` with
+    fancy indexing. The regression is solved in float32 by one of the following solvers:
+
+     * "lstsq": ordinary least squares with an intercept (the same model as sklearn's
+       `LinearRegression`), solved with `numpy.linalg.lstsq` on the centred sample.
+     * "procrustes": the orthogonal transformation that best maps the sample of model1 onto the
+       sample of model2 (requires vectors of the same size). This has no intercept.
+     * "sklearn": sklearn's `LinearRegression`.
+
+    ::param model1:: a `VectorSpaceModel` or gensim `KeyedVectors` instance for the LHS
+    ::param model2:: a `VectorSpaceModel` or gensim `KeyedVectors` instance for the RHS
     ::param samplesize:: a float or int specifying how much of the vocab to use to fit the model.
-    ::returns:: a `sklearn.linear_model.LinearRegression` object.
+    ::param seed:: seed for the random sample of the vocab.
+    ::param solver:: "lstsq", "procrustes" or "sklearn".
+    ::param rows:: optionally, the `(rows1, rows2)` of the common vocab, as from `common_rows`.
+    ::returns:: a `LinearTransform` (or an sklearn `LinearRegression` for the "sklearn" solver).
     """
-    common_vocab = set(model1.vocab.keys()).intersection(set(model2.vocab.keys()))
-    if "</s>" in common_vocab:
-        common_vocab.remove("</s>")
-    debug("{:,} words in model 1".format(len(model1.vocab)))
-    debug("{:,} words in model 2".format(len(model2.vocab)))
-    debug("{:,} words common to both models".format(len(common_vocab)))
+    if rows is None:
+        rows = common_rows(model1, model2)
+    rows1, rows2 = rows
+    debug("{:,} words in model 1", len(model1.index2word))
+    debug("{:,} words in model 2", len(model2.index2word))
+    debug("{:,} words common to both models", len(rows1))
     if type(samplesize) == float:
-        samplesize = int(samplesize * len(common_vocab))
-    debug("Sampling {:,} words from the common vocab".format(samplesize))
-    d1 = model1.vector_size
-    d2 = model2.vector_size
-    sample = random.sample(common_vocab, samplesize)
-    X = np.ndarray((samplesize, d1), dtype=np.float32)
-    Y = np.ndarray((samplesize, d2), dtype=np.float32)
-    # Pretty sure this loop is not an efficient way to sample things...
-    for i, word in enumerate(sample):
-        X[i, :] = model1[word]
-        Y[i, :] = model2[word]
-    debug("Fitting linear regression with {:,} samples".format(samplesize))
-    regression = LinearRegression()
-    regression.fit(X, Y)
-    return regression
+        samplesize = int(samplesize * len(rows1))
+    debug("Sampling {:,} words from the common vocab", samplesize)
+    with metrics.timer("fit"):
+        sample = np.sort(np.random.RandomState(seed).choice(len(rows1), samplesize, replace=False))
+        X = np.asarray(model1.syn0[rows1[sample]], dtype=np.float32)
+        Y = np.asarray(model2.syn0[rows2[sample]], dtype=np.float32)
+        debug("Fitting {:} regression with {:,} samples", solver, samplesize)
+        return _solve_regression(X, Y, solver)
+
+
+def _solve_regression(X, Y, solver):
+    """Solve the regression of Y on X with the given solver (see `fit_w2v_regression`). X and Y
+    may be modified."""
+    if solver == "lstsq":
+        mean_x = X.mean(axis=0)
+        mean_y = Y.mean(axis=0)
+        X -= mean_x
+        Y -= mean_y
+        W = np.linalg.lstsq(X, Y, rcond=None)[0]
+        return LinearTransform(W.T.copy(), mean_y - np.dot(mean_x, W))
+    elif solver == "procrustes":
+        if X.shape[1] != Y.shape[1]:
+            raise ValueError("The procrustes solver requires vectors of the same size.")
+        U, _, Vt = np.linalg.svd(np.dot(X.T, Y))
+        W = np.dot(U, Vt)
+        return LinearTransform(W.T.copy(), np.zeros(Y.shape[1], dtype=np.float32))
+    elif solver == "sklearn":
+        from sklearn.linear_model import LinearRegression
+        regression = LinearRegression()
+        regression.fit(X, Y)
+        return regression
+    raise ValueError("Unknown solver '{:}'".format(solver))
+
 
+@metrics.timed("transform")
 def apply_wv2_regression(model, regression):
     """Given a word2vec model and a linear regression, apply that regression to all the vectors
     in the model.
@@ -212,12 +743,13 @@ def apply_wv2_regression(model, regression):
     ::returns:: A gensim `KeyedVectors` instance
     """
     debug("Applying transformation")
+    KeyedVectors, _ = _import_gensim()
     model_t = KeyedVectors() # Word2Vec()
     model_t.wv.vocab = model.vocab.copy()
     model_t.wv.vector_size = model.vector_size
     model_t.wv.index2word = model.index2word
     # model_t.reset_weights()
-    debug("Transforming {:,} vectors".format(len(model.syn0)))
+    debug("Transforming {:,} vectors", len(model.syn0))
     # N.B. Somehow I get float64 here and that's not what I want, so I'm explicitly casting to float32
     model_t.syn0 = regression.predict(model.syn0).astype(np.float32)
     return model_t
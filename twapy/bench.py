@@ -0,0 +1,247 @@
+"""Benchmarks for the main stages of twapy, on synthetic models.
+
+This module generates synthetic word2vec models of a configurable vocabulary size and vector size,
+so that benchmarks do not depend on downloaded models, and times each stage of solving temporal
+word analogies:
+
+ * `load`: `VectorSpaceModel.load` of a word2vec `.bin` file
+ * `fit`: `fit_w2v_regression`
+ * `transform`: the vectors of an `AlignedModel`, i.e. `transform_vectors` over the whole
+   vocabulary
+ * `solve`: `Analogy.solve` for single words
+ * `analogies`: `Alignment.analogies` for a batch of words
+ * `evaluate_pair`: `Evaluation.evaluate_pair` against a synthetic ground truth
+ * `import`: a cold `import twapy`, in a fresh interpreter for each call
+
+For each stage, the report gives the latency percentiles (in milliseconds), the throughput (calls,
+or words for the batched stages, per second) and the peak memory allocated during one call. The
+report is a JSON document, so the results of different releases can be compared. To run the
+benchmarks from the command line:
+
+    python -m twapy.bench --vocab-size 100000 --dim 300 --output bench.json
+
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from . import __verion__ as version
+from .models import VectorSpaceModel
+from .alignment import AlignedModel, Alignment, Analogy, fit_w2v_regression
+from .evaluate import Evaluation
+
+
+def generate_vectors(vocab_size, dim, nmodels=2, overlap=0.9, noise=0.1, seed=0):
+    """Generate the words and vectors of `nmodels` synthetic models.
+
+    All models are noisy, randomly rotated copies of the same base vectors, and each contains a
+    random `overlap` fraction of the base vocabulary (in the order of the base vocabulary, as
+    word2vec files are ordered by frequency).
+
+    ::returns:: a list of `(words, vectors)` tuples, one per model.
+    """
+    rng = np.random.RandomState(seed)
+    words = np.array(["w{:d}".format(i) for i in range(vocab_size)])
+    base = rng.randn(vocab_size, dim).astype(np.float32)
+    models = []
+    for _ in range(nmodels):
+        rotation = np.linalg.qr(rng.randn(dim, dim))[0].astype(np.float32)
+        keep = np.sort(rng.choice(vocab_size, int(overlap * vocab_size), replace=False))
+        vectors = base[keep] + noise * rng.randn(len(keep), dim).astype(np.float32)
+        models.append((words[keep].tolist(), np.dot(vectors, rotation)))
+    return models
+
+
+def write_w2v(filename, words, vectors):
+    """Write a model in the binary word2vec format."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    with open(filename, "wb") as f:
+        f.write("{:d} {:d}\n".format(*vectors.shape).encode("utf-8"))
+        for word, vector in zip(words, vectors):
+            f.write(word.encode("utf-8") + b" " + vector.tobytes() + b"\n")
+    return filename
+
+
+def make_models(directory, truth_fn, vocab_size, dim, nmodels=2, seed=0):
+    """Write `nmodels` synthetic models to `directory`, named "2000.bin", "2001.bin", etc.,
+    and a ground truth file `truth_fn` of words that are in every model.
+
+    ::returns:: the list of model names.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    names = [str(2000 + i) for i in range(nmodels)]
+    common = None
+    for name, (words, vectors) in zip(names, generate_vectors(vocab_size, dim, nmodels,
+                                                              seed=seed)):
+        write_w2v(os.path.join(directory, name + ".bin"), words, vectors)
+        common = set(words) if common is None else common.intersection(words)
+    rng = np.random.RandomState(seed)
+    truth = rng.choice(sorted(common), min(10, len(common)), replace=False)
+    with open(truth_fn, "w", encoding="utf-8") as f:
+        f.write("Year," + ",".join("c{:d}".format(i) for i in range(len(truth))) + "\n")
+        for name in names:
+            f.write(name + "," + ",".join(truth) + "\n")
+    return names
+
+
+def time_stage(name, func, repeats=5, items=1):
+    """Time `repeats` calls of `func`.
+
+    The peak memory is measured with `tracemalloc` in one extra call, so that tracing does not
+    slow down the timed calls. `items` is the number of items processed per call, which is used
+    for the throughput.
+
+    ::returns:: a dict with the statistics of the stage.
+    """
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t0)
+    return _stage_report(name, latencies, items, peak)
+
+
+def time_import(repeats=5):
+    """Time `repeats` cold imports of twapy, each in a fresh Python interpreter.
+
+    ::returns:: a dict with the statistics of the stage (without the peak memory).
+    """
+    code = "import time; t0 = time.perf_counter(); import twapy; print(time.perf_counter() - t0)"
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    latencies = [float(subprocess.check_output([sys.executable, "-c", code], env=env))
+                 for _ in range(repeats)]
+    return _stage_report("import", latencies)
+
+
+def _stage_report(name, latencies, items=1, peak=None):
+    latencies = np.array(latencies) * 1000.0
+    return {
+        "stage": name,
+        "repeats": len(latencies),
+        "items_per_call": items,
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "min": float(latencies.min()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max()),
+        },
+        "throughput_per_s": float(items * len(latencies) / (latencies.sum() / 1000.0)),
+        "peak_memory_bytes": None if peak is None else int(peak),
+    }
+
+
+def run(vocab_size=100000, dim=300, nqueries=100, repeats=5, seed=0, directory=None):
+    """Run all the benchmarks, and return the report as a dict.
+
+    ::param vocab_size:: the size of the base vocabulary of the synthetic models
+    ::param dim:: the size of the vectors
+    ::param nqueries:: the number of words solved by the `solve` and `analogies` stages
+    ::param repeats:: the number of timed calls of each stage (the `solve` stage times each of
+        its `nqueries` calls instead)
+    ::param directory:: where to write the synthetic models (by default, a temporary directory
+        that is removed afterwards)
+    """
+    tmpdir = None
+    if directory is None:
+        directory = tmpdir = tempfile.mkdtemp(prefix="twapy-bench-")
+    try:
+        models_dir = os.path.join(directory, "models")
+        truth_fn = os.path.join(directory, "groundtruth.csv")
+        names = make_models(models_dir, truth_fn, vocab_size, dim, seed=seed)
+        fn1, fn2 = [os.path.join(models_dir, name + ".bin") for name in names]
+        stages = [time_import(repeats)]
+        stages.append(time_stage("load", lambda: VectorSpaceModel.load(fn1), repeats))
+        model1 = VectorSpaceModel.load(fn1)
+        model2 = VectorSpaceModel.load(fn2)
+        stages.append(time_stage(
+            "fit", lambda: fit_w2v_regression(model1, model2, seed=seed), repeats))
+        regression = fit_w2v_regression(model1, model2, seed=seed)
+        stages.append(time_stage(
+            "transform", lambda: AlignedModel(model1, regression).syn0, repeats,
+            items=len(model1)))
+        alignment = Alignment(model1, model2, regression=regression)
+        rng = np.random.RandomState(seed)
+        words = [model1.index2word[i] for i in rng.choice(len(model1), nqueries)]
+        queries = iter(words * 2)
+        analogy = Analogy(words[0], alignment=alignment)
+
+        def solve():
+            analogy.word1 = next(queries)
+            analogy.solve()
+        stages.append(time_stage("solve", solve, len(words) - 1))
+        stages.append(time_stage(
+            "analogies", lambda: alignment.analogies(words), repeats, items=len(words)))
+        output_fn = os.path.join(directory, "evaluation_output.tsv")
+        evaluation = Evaluation(truth_fn, models_dir, output_fn=output_fn, seed=seed)
+
+        def evaluate_pair():
+            evaluation.evaluate_pair(names[0], names[1])
+            os.remove(output_fn)
+        stages.append(time_stage("evaluate_pair", evaluate_pair, repeats,
+                                 items=len(evaluation.e.columns)))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return {
+        "twapy_version": version,
+        "python_version": platform.python_version(),
+        "numpy_version": np.__version__,
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "vocab_size": vocab_size,
+            "dim": dim,
+            "nqueries": nqueries,
+            "repeats": repeats,
+            "seed": seed,
+        },
+        "stages": stages,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark twapy on synthetic models.")
+    parser.add_argument("--vocab-size", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=300)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--directory", default=None,
+                        help="directory for the synthetic models (default: a temporary directory)")
+    parser.add_argument("--output", default=None, help="file to write the JSON report to")
+    args = parser.parse_args(argv)
+    # Keep progress messages out of the JSON report.
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(vocab_size=args.vocab_size, dim=args.dim, nqueries=args.queries,
+                     repeats=args.repeats, seed=args.seed, directory=args.directory)
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -7,17 +7,24 @@ github repository.
 The `score_evaluation.py` script uses this module to score the accuracy of the outputs generated
 by the `run_evaluation.py` script.
 
+`score_evaluation` reads an output file once, in chunks, and returns the accuracy, baseline,
+agreement and null rates grouped by year gap, by ground truth category and by pair of models:
 
+>>> scores = score_evaluation('evaluation_output.tsv', 'groundtruth.csv')
+>>> scores["by_gap"].accuracy
 
 """
 
 
+import csv
+import multiprocessing
 import os
-import pandas as pd
 import random
+from collections import OrderedDict
 
+from . import info, metrics
 from .models import ModelCollection
-from .alignment import Alignment
+from .alignment import Alignment, AlignmentStore, AnchorSpace
 
 
 class EvaluationError(Exception):
@@ -28,66 +35,235 @@ class Evaluation(object):
 
     """This is a class to run an evaluation of a set of models against a ground truth set of analogies.
 
+    If `alignment_dir` is given, fitted alignments are saved to (and reused from) an
+    `AlignmentStore` in that directory.
+
+    If `workers` is greater than 1, pairs of models are evaluated in a pool of that many
+    processes. The pairs are grouped by their source model, so that each worker loads a source
+    model once and evaluates all of its pairs, and the results are written by the main process.
+
+    If `resume` is True and the output file already exists, the pairs that are already complete
+    in the file are skipped, so that an interrupted evaluation can be continued. The rows of each
+    pair are written to the file with a single write, and any incomplete pair left by an
+    interruption is removed from the file before resuming.
+
+    If `anchor` is given, each model is aligned once onto a shared reference space (an
+    `AnchorSpace`) and pairs are evaluated through it, rather than fitting an alignment for every
+    pair. `anchor` is the name of the reference model, or True to use the default reference.
+    `compare_anchor` reports how the accuracy of the two approaches differs.
+
+    `limit` and `restrict_vocab` are passed on to the `ModelCollection`: they limit the number of
+    words loaded from each model, and the number of words searched for the answers.
+
     """
 
-    def __init__(self, evals_fn, models_dir="", samplesize=0.5, output_fn="evaluation_output.tsv"):
+    def __init__(self, evals_fn, models_dir="", samplesize=0.5, output_fn="evaluation_output.tsv",
+                 seed=None, alignment_dir=None, workers=1, resume=False, anchor=None, limit=None,
+                 restrict_vocab=None):
         self.samplesize = samplesize
-        self.collection = ModelCollection(models_dir)
+        self.seed = seed
+        self.workers = workers
+        self.models_dir = models_dir
+        self.limit = limit
+        self.restrict_vocab = restrict_vocab
+        self.store = AlignmentStore(alignment_dir) if alignment_dir is not None else None
+        self.anchor = anchor
+        self._anchor_space = None
+        self.collection = ModelCollection(models_dir, limit=limit, restrict_vocab=restrict_vocab)
+        # pandas is imported here rather than at the top of the module, as it is slow to import.
+        import pandas as pd
         self.e = pd.read_csv(evals_fn, encoding="utf-8", index_col=0)
         # Indexes might look like ints (e.g. 1987), but treat them as strings:
         self.e.index = self.e.index.astype("str")
         # Remove any models that don't exist.
         self.e = self.e.loc[self.collection.modelnames]
         self.output_fn = output_fn
+        self.completed = set()
         if os.path.exists(output_fn):
-            # Don't want to accidentally overwrite an existing file.
-            raise EvaluationError("Output file already exists.")
+            if not resume:
+                # Don't want to accidentally overwrite an existing file.
+                raise EvaluationError("Output file already exists.")
+            self.completed = self._recover_output()
+            print("Resuming evaluation: {:d} pairs already complete.".format(len(self.completed)))
+        return
+
+    def _recover_output(self):
+        """Find the pairs that are complete in the existing output file, and rewrite the file
+        without the rows of any incomplete pair. Returns the set of complete pairs."""
+        counts = {}
+        lines = []
+        with open(self.output_fn, encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if not line.endswith("\n") or len(fields) != 5:
+                    continue
+                pair = (fields[0], fields[1])
+                counts[pair] = counts.get(pair, 0) + 1
+                lines.append((pair, line))
+        completed = set(pair for pair, n in counts.items() if n == len(self.e.columns))
+        if len(completed) < len(counts):
+            print("Removing {:d} incomplete pairs from {:}".format(
+                len(counts) - len(completed), self.output_fn))
+        tmp = self.output_fn + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("".join(line for pair, line in lines if pair in completed))
+        os.replace(tmp, self.output_fn)
+        return completed
+
+    def __getstate__(self):
+        # The model collection is not sent to worker processes; each worker opens its own.
+        state = self.__dict__.copy()
+        del state["collection"]
+        state["_anchor_space"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.collection = ModelCollection(self.models_dir, limit=self.limit,
+                                          restrict_vocab=self.restrict_vocab)
         return
 
 
     def evaluate_all(self):
         print("Evaluation all pairs of:", self.e.index.values)
-        for mn1 in self.e.index.values:
-            for mn2 in self.e.index.values:
-                if mn1 == mn2:
-                    continue
-                self.evaluate_pair(mn1, mn2)
+        pairs = [(mn1, mn2) for mn1 in self.e.index.values for mn2 in self.e.index.values
+                 if mn1 != mn2]
+        self.evaluate_pairs(pairs)
 
 
     def evaluate_all_from(self, mn1):
         print("Evaluation all pairs from {:} to {:}".format(
             mn1, self.e.index.values))
-        for mn2 in self.e.index.values:
-            if mn1 == mn2:
-                continue
-            self.evaluate_pair(mn1, mn2)
+        self.evaluate_pairs([(mn1, mn2) for mn2 in self.e.index.values if mn1 != mn2])
 
 
     def evaluate_sample(self, n=10):
         sample = self.sample(n)
-        for mn1, mn2 in sample:
-            self.evaluate_pair(mn1, mn2)
+        self.evaluate_pairs(sample)
+        return
+
+
+    def evaluate_pairs(self, pairs):
+        """Evaluate a list of `(mn1, mn2)` pairs of models, in parallel if `self.workers` > 1.
+        Pairs that are already complete in the output file are skipped. The timings of the stages
+        of this evaluation (see `twapy.metrics`) are logged at the end."""
+        pairs = [pair for pair in pairs if tuple(pair) not in self.completed]
+        with metrics.scope() as run_metrics:
+            if self.workers is None or self.workers <= 1:
+                for mn1, mn2 in pairs:
+                    self.evaluate_pair(mn1, mn2)
+            else:
+                self._evaluate_parallel(pairs)
+        info("Timings of the evaluation of {:d} pairs:\n{:}", len(pairs),
+             run_metrics.format_summary())
+        return
+
+
+    def _evaluate_parallel(self, pairs):
+        groups = OrderedDict()
+        for mn1, mn2 in pairs:
+            groups.setdefault(mn1, []).append(mn2)
+        print("Evaluating {:d} pairs from {:d} models with {:d} workers".format(
+            len(pairs), len(groups), self.workers))
+        # Build (and save) the global vocabulary once, before the workers start, so that the
+        # workers load it from the cache directory rather than each building it.
+        self.collection.vocabulary
+        pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self,))
+        try:
+            for results, timings in pool.imap_unordered(_evaluate_group, groups.items()):
+                for mn1, mn2, rows in results:
+                    self.write_rows(rows)
+                metrics.merge(timings)
+        finally:
+            pool.close()
+            pool.join()
         return
 
 
     def evaluate_pair(self, mn1, mn2):
+        self.write_rows(self.predict_pair(mn1, mn2))
+        return
+
+
+    @property
+    def anchor_space(self):
+        """The `AnchorSpace` used when `anchor` is set."""
+        if self._anchor_space is None:
+            # `anchor` is the name of the reference model, or True (or unset, when the space is
+            # only used by `compare_anchor`) for the default reference.
+            reference = self.anchor if isinstance(self.anchor, str) else None
+            self._anchor_space = AnchorSpace(self.collection, reference=reference,
+                                             samplesize=self.samplesize, seed=self.seed,
+                                             store=self.store)
+        return self._anchor_space
+
+
+    def predict_pair(self, mn1, mn2, anchor=None):
+        """Solve the ground truth analogies from model `mn1` to model `mn2`, and return the list
+        of output rows `(mn1, mn2, word1, gold word2, predicted word2)`. The alignment is made
+        through the anchor space if `anchor` (by default, `self.anchor`) is set."""
         print("Evaluating {:} -> {:}".format(mn1, mn2))
-        a = Alignment(mn1, mn2, collection=self.collection, samplesize=self.samplesize)
+        if anchor is None:
+            anchor = self.anchor
+        if anchor:
+            a = self.anchor_space.alignment(mn1, mn2)
+        else:
+            a = Alignment(mn1, mn2, collection=self.collection, samplesize=self.samplesize,
+                          seed=self.seed, store=self.store)
+        words = [self.e.loc[mn1, col] for col in self.e.columns]
+        results = a.analogies(words, topn=1)
+        rows = []
+        for col, w1, result in zip(self.e.columns, words, results):
+            w2 = self.e.loc[mn2, col]
+            if result is None:
+                print("WARNING! Word {:} is not in model {:}.".format(w1, mn1))
+                w2_predicted = "ERROR"
+            else:
+                w2_predicted = result[0][0]
+            rows.append((mn1, mn2, str(w1), str(w2), w2_predicted))
+        return rows
+
+
+    def write_rows(self, rows):
+        """Append the rows of one pair to the output file, in a single write."""
         with open(self.output_fn, "a", encoding="utf-8") as f:
-            for col in self.e.columns:
-                w1 = self.e.loc[mn1, col]
-                w2 = self.e.loc[mn2, col]
-                try:
-                    w2_predicted = a.analogy(w1).word2
-                except Exception as e:
-                    print("WARNING! Something is wrong.")
-                    print(e)
-                    # Something happened
-                    w2_predicted = "ERROR"
-                f.write("\t".join([mn1, mn2, w1, w2, w2_predicted]) + "\n")
+            f.write("".join("\t".join(row) + "\n" for row in rows))
+            f.flush()
+            os.fsync(f.fileno())
+        for row in rows:
+            self.completed.add((row[0], row[1]))
         return
 
 
+    def score(self, chunksize=1000000, errors_as_null=False):
+        """Score the output file against the ground truth (see `score_evaluation`)."""
+        return score_evaluation(self.output_fn, self.e, chunksize=chunksize,
+                                errors_as_null=errors_as_null)
+
+
+    def compare_anchor(self, pairs=None):
+        """Compare the accuracy of direct pairwise alignments with alignments through the anchor
+        space, on the given pairs (by default, all pairs). Nothing is written to the output file.
+
+        ::returns:: a DataFrame with the accuracy of each method for each pair.
+        """
+        if pairs is None:
+            pairs = [(mn1, mn2) for mn1 in self.e.index.values for mn2 in self.e.index.values
+                     if mn1 != mn2]
+        import pandas as pd
+        rows = []
+        for mn1, mn2 in pairs:
+            direct = self.predict_pair(mn1, mn2, anchor=False)
+            anchored = self.predict_pair(mn1, mn2, anchor=True)
+            rows.append((mn1, mn2,
+                         sum(r[3] == r[4] for r in direct) / float(len(direct)),
+                         sum(r[3] == r[4] for r in anchored) / float(len(anchored))))
+        df = pd.DataFrame(rows, columns=["year1", "year2", "direct", "anchor"])
+        print("Accuracy with direct alignments: {:5.1f}%".format(100.0 * df.direct.mean()))
+        print("Accuracy with the anchor space:  {:5.1f}%".format(100.0 * df.anchor.mean()))
+        return df
+
+
     def sample(self, n=10):
         """Generate a sample of distinct pairs of models. 
         """
@@ -106,24 +282,160 @@ class Evaluation(object):
         return list(sample)
 
 
-def score_evaluation_file(filename, min_diff=None, max_diff=None):
+# The `Evaluation` instance of a worker process, set by `_init_worker`.
+_worker_evaluation = None
+
+
+def _init_worker(evaluation):
+    global _worker_evaluation
+    _worker_evaluation = evaluation
+    return
+
+
+def _evaluate_group(group):
+    """Evaluate all the pairs from one source model in a worker process, and return the results
+    with the timings of the stages of this group."""
+    mn1, targets = group
+    metrics.reset()
+    results = [(mn1, mn2, _worker_evaluation.predict_pair(mn1, mn2)) for mn2 in targets]
+    return results, metrics.summary()
+
+
+# The columns of an evaluation output file, the counts computed for each group of rows when
+# scoring it, and the predictions that mean that no analogy was found (and, with
+# `errors_as_null`, the prediction written for words that are not in the first model).
+OUTPUT_COLUMNS = ['year1', 'year2', 'original', 'gold', 'predicted']
+COUNT_COLUMNS = ['total', 'correct', 'baseline', 'agree', 'null']
+NO_PREDICTION = ['NONE']
+ERROR_PREDICTION = 'ERROR'
+
+
+def score_evaluation(filename, groundtruth=None, chunksize=1000000, errors_as_null=False):
+    """Score an evaluation output file, reading it once in chunks of `chunksize` rows.
+
+    The rows are counted by pair of models and ground truth category in a single pass, and the
+    counts are then summed by year gap (the absolute difference between the two model names, when
+    they are numbers), by category and by pair. Each row is assigned the category of the ground
+    truth column in which its original word appears for its first model.
+
+    ::param groundtruth:: the ground truth CSV file (or `DataFrame`, indexed by model name) used
+        for the evaluation. If it is not given, the rows are not grouped by category.
+    ::param errors_as_null:: if True, the rows of words that are not in the first model (predicted
+        as "ERROR") are counted as having no prediction, as well as the "NONE" predictions
+    ::returns:: a dict of DataFrames, "overall", "by_gap", "by_category" (None without a ground
+        truth) and "by_pair", with the `total`, `correct`, `baseline`, `agree` and `null` counts
+        of each group and the corresponding rates `accuracy`, `baseline_accuracy`, `agreement`
+        and `null_rate`.
+    """
+    import pandas as pd
+    categories = None
+    if groundtruth is not None:
+        categories = _category_lookup(groundtruth)
+    reader = []
+    if os.path.getsize(filename) > 0:
+        reader = pd.read_csv(filename, sep="\t", header=None, names=OUTPUT_COLUMNS, dtype=object,
+                             keep_default_na=False, quoting=csv.QUOTE_NONE, encoding="utf-8",
+                             chunksize=chunksize)
+    no_prediction = NO_PREDICTION + [ERROR_PREDICTION] if errors_as_null else NO_PREDICTION
+    counts = [_count_chunk(chunk, categories, no_prediction) for chunk in reader]
+    if counts:
+        counts = pd.concat(counts).groupby(level=[0, 1, 2], sort=False).sum().reset_index()
+    else:
+        counts = pd.DataFrame(columns=['year1', 'year2', 'category'] + COUNT_COLUMNS)
+    counts["gap"] = (pd.to_numeric(counts.year2, errors="coerce") -
+                     pd.to_numeric(counts.year1, errors="coerce")).abs()
+    overall = counts[COUNT_COLUMNS].sum().to_frame("all").T
+    by_gap = counts.groupby("gap")[COUNT_COLUMNS].sum()
+    if (by_gap.index % 1 == 0).all():
+        by_gap.index = by_gap.index.astype("int64")
+    return {
+        "overall": _rates(overall),
+        "by_gap": _rates(by_gap),
+        "by_category": (_rates(counts.groupby("category")[COUNT_COLUMNS].sum())
+                        if categories is not None else None),
+        "by_pair": _rates(counts.groupby(["year1", "year2"])[COUNT_COLUMNS].sum()),
+    }
+
+
+def _category_lookup(groundtruth):
+    """Return a Series mapping `(model name, word)` to the ground truth category of the word."""
+    import pandas as pd
+    if not isinstance(groundtruth, pd.DataFrame):
+        groundtruth = pd.read_csv(groundtruth, encoding="utf-8", index_col=0, dtype=str,
+                                  keep_default_na=False)
+    table = groundtruth.copy()
+    table.index = table.index.astype("str")
+    table.index.name = "year"
+    table = table.reset_index().melt(id_vars="year", var_name="category", value_name="word")
+    table["word"] = table.word.astype("str")
+    table = table.drop_duplicates(["year", "word"])
+    return table.set_index(["year", "word"]).category
+
+
+def _count_chunk(chunk, categories, no_prediction=NO_PREDICTION):
+    """Count the rows of one chunk of an output file by pair of models and category."""
+    import numpy as np
+    import pandas as pd
+    # Group on integer codes rather than on the strings, which is much faster.
+    codes1, names1 = pd.factorize(chunk.year1.values)
+    codes2, names2 = pd.factorize(chunk.year2.values)
+    if categories is not None:
+        # Look up the category of each distinct (model, word) pair only once.
+        words, names = pd.factorize(chunk.original.values)
+        pairs, keys = pd.factorize(codes1 * len(names) + words)
+        category = categories.reindex(pd.MultiIndex.from_arrays(
+            [names1[keys // len(names)], names[keys % len(names)]])).fillna("").values
+        codes3, names3 = pd.factorize(category[pairs])
+    else:
+        codes3, names3 = np.zeros(len(chunk), dtype=np.int64), np.array([""], dtype=object)
+    group, keys = pd.factorize((codes1 * len(names2) + codes2) * len(names3) + codes3)
+    counts = {"total": np.bincount(group, minlength=len(keys))}
+    for column, flags in (("correct", chunk.gold.values == chunk.predicted.values),
+                          ("baseline", chunk.gold.values == chunk.original.values),
+                          ("agree", chunk.predicted.values == chunk.original.values),
+                          ("null", chunk.predicted.isin(no_prediction).values)):
+        counts[column] = np.bincount(group, weights=flags, minlength=len(keys)).astype(np.int64)
+    index = pd.MultiIndex.from_arrays([
+        names1[keys // (len(names2) * len(names3))],
+        names2[keys // len(names3) % len(names2)],
+        names3[keys % len(names3)],
+    ], names=["year1", "year2", "category"])
+    return pd.DataFrame(counts, index=index, columns=COUNT_COLUMNS)
+
+
+def _rates(counts):
+    """Add the rates corresponding to the counts of each group."""
+    counts = counts.astype("int64")
+    total = counts.total.where(counts.total > 0)
+    counts["accuracy"] = counts.correct / total
+    counts["baseline_accuracy"] = counts.baseline / total
+    counts["agreement"] = counts.agree / total
+    counts["null_rate"] = counts.null / total
+    return counts
+
+
+def score_evaluation_file(filename, min_diff=None, max_diff=None, errors_as_null=False):
     """Once an evaluation file has been produced, this will summarize the
-    results and compute the accuracy."""
-    df = pd.read_table(filename, index_col=None, header=None, encoding="utf-8")
-    df.columns = ['year1', 'year2', 'original', 'gold', 'predicted']
-    if min_diff is not None:
-        df = df[(df.year2-df.year1).abs() >= min_diff]
-    if min_diff is not None:
-        df = df[(df.year2-df.year1).abs() <= min_diff]
-    correct = (df.gold == df.predicted).sum()
-    baseline = (df.gold == df.original).sum()
-    agree = (df.predicted == df.original).sum()
-    null = (df.predicted=="NONE").sum()
-    total = len(df)
-    accuracy = 100.0 * correct / total
-    nullpct = 100.0 * null / total
-    basepct = 100.0 * baseline / total
-    agreepct = 100.0 * agree /total
+    results and compute the accuracy, over the pairs of models whose year gap is between
+    `min_diff` and `max_diff` (inclusive) if they are given. Only "NONE" predictions count as
+    no prediction, unless `errors_as_null` is True (see `score_evaluation`)."""
+    scores = score_evaluation(filename, errors_as_null=errors_as_null)
+    if min_diff is None and max_diff is None:
+        counts = scores["overall"].iloc[0]
+    else:
+        gaps = scores["by_gap"]
+        if min_diff is not None:
+            gaps = gaps[gaps.index >= min_diff]
+        if max_diff is not None:
+            gaps = gaps[gaps.index <= max_diff]
+        counts = gaps[COUNT_COLUMNS].sum()
+    correct, baseline, agree, null, total = [int(counts[c]) for c in
+                                             ['correct', 'baseline', 'agree', 'null', 'total']]
+    total_ = max(total, 1)
+    accuracy = 100.0 * correct / total_
+    nullpct = 100.0 * null / total_
+    basepct = 100.0 * baseline / total_
+    agreepct = 100.0 * agree / total_
     print("{:5.1f}% ({:} out of {:}) correctly predicted.".format(
         accuracy, correct, total))
     print("{:5.1f}% ({:} out of {:}) predicted by baseline.".format(
@@ -136,14 +448,9 @@ def score_evaluation_file(filename, min_diff=None, max_diff=None):
 
 
 def accuracy_over_time(filename):
-    df = pd.read_table(filename, index_col=None, header=None, encoding="utf-8")
-    df.columns = ['year1', 'year2', 'original', 'gold', 'predicted']
-    spread = df.year1.max() - df.year1.min()
-    ts = pd.DataFrame(index=range(1, spread))
-    ts["prediction"] = 0.0
-    ts["baseline"] = 0.0
-    for i in range(1, spread):
-        c, b, a, n, t = score_evaluation_file(filename, min_diff=i, max_diff=i)
-        ts.loc[i, "prediction"] = c / t
-        ts.loc[i, "baseline"] = b / t
-    return ts
+    """Return the accuracy of the predictions and of the baseline for each year gap, from a
+    single pass over the evaluation output file."""
+    import pandas as pd
+    by_gap = score_evaluation(filename)["by_gap"]
+    by_gap = by_gap[by_gap.index > 0]
+    return pd.DataFrame({"prediction": by_gap.accuracy, "baseline": by_gap.baseline_accuracy})
@@ -0,0 +1,100 @@
+"""Hosting models for servers with several worker processes.
+
+When a server runs several worker processes (e.g. under gunicorn or uWSGI), each worker that loads
+the models from word2vec files holds its own copy of every model, of its normalised vectors and of
+every aligned model. `export_models` instead writes, once, all of these matrices as files in the
+twapy-native format to a shared directory:
+
+ * each model, with its normalised vectors (see `VectorSpaceModel.save_native`)
+ * the global vocabulary of the models (see `GlobalVocabulary`)
+ * for the given pairs of models, the fitted alignment and the vectors of the aligned model, in
+   an `AlignmentStore` in the `alignments` subdirectory (see `AlignmentStore.save_aligned`)
+
+Workers then open the shared directory with `ModelCollection` and `AlignmentStore` as usual, and
+all of the matrices are memory-mapped read-only, so the workers share the same physical pages
+and a box can run N workers without N times the memory:
+
+>>> from twapy.hosting import export_models
+>>> export_models('models', 'shared', pairs=[('1987', '1997')])
+'shared'
+
+The web server uses the shared directory given by the `TWAPY_SHARED_DIR` environment variable
+(see `twapy.server`). The export can be run from the command line before starting the workers:
+
+    python -m twapy.hosting models shared --pair 1987 1997
+
+"""
+
+import argparse
+import os
+
+from .models import ModelCollection, NATIVE_EXTENSION, _model_files, _model_name
+from .alignment import Alignment, AlignmentStore
+from . import configure_logging, info
+
+
+# The subdirectory of a shared directory that holds the alignment store.
+ALIGNMENT_SUBDIRECTORY = "alignments"
+
+
+def export_models(models_dir, directory, pairs=(), samplesize=0.5, seed=None, solver="lstsq",
+                  limit=None):
+    """Export the models in `models_dir`, and the alignments of `pairs` of models, to the shared
+    directory `directory`.
+
+    Models whose native file in `directory` is newer than the original model file are not
+    exported again, and alignments that are already in the store are not refit.
+
+    ::param pairs:: a list of `(modelname1, modelname2)` pairs whose aligned models are exported
+    ::param samplesize:: the sample size, seed and solver of the alignments (see `Alignment`),
+        which must match those used by the workers
+    ::param limit:: if given, only the first `limit` words of each model are exported
+    ::returns:: the shared directory
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # Keep only one source model in memory at a time.
+    source = ModelCollection(models_dir, limit=limit, cache_bytes=0)
+    for fn in _model_files(models_dir):
+        modelname = _model_name(fn)
+        original = os.path.join(models_dir, fn)
+        filename = os.path.join(directory, modelname + NATIVE_EXTENSION)
+        if os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(original):
+            continue
+        info("Exporting model {:} to {:}", modelname, filename)
+        source[modelname].save_native(filename, normalized=True)
+    shared = ModelCollection(directory)
+    # Build the global vocabulary once, rather than in every worker.
+    shared.vocabulary
+    store = AlignmentStore(os.path.join(directory, ALIGNMENT_SUBDIRECTORY))
+    for modelname1, modelname2 in pairs:
+        alignment = Alignment(modelname1, modelname2, collection=shared, samplesize=samplesize,
+                              seed=seed, store=store, solver=solver)
+        if not os.path.exists(store.aligned_filename(alignment.model1, alignment.model2,
+                                                     samplesize, seed, solver)):
+            info("Exporting aligned model {:}", alignment.name)
+            store.save_aligned(alignment.model3, alignment.model1, alignment.model2,
+                               samplesize, seed, solver)
+    return directory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export models and aligned models to a directory shared by server workers.")
+    parser.add_argument("models_dir")
+    parser.add_argument("directory")
+    parser.add_argument("--pair", nargs=2, action="append", default=[],
+                        metavar=("MODEL1", "MODEL2"), help="a pair of models to align")
+    parser.add_argument("--samplesize", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--solver", default="lstsq")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args(argv)
+    configure_logging(level="INFO")
+    return export_models(args.models_dir, args.directory, pairs=[tuple(p) for p in args.pair],
+                         samplesize=args.samplesize, seed=args.seed, solver=args.solver,
+                         limit=args.limit)
+
+
+if __name__ == "__main__":
+    main()
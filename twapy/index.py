@@ -0,0 +1,190 @@
+"""Approximate nearest-neighbour search over the vectors of a model.
+
+An exact nearest-neighbour search compares the query with every vector in the model, which
+dominates the cost of solving an analogy with a large model. The `IVFIndex` class implements an
+inverted-file index in NumPy: the normalised vectors are clustered with spherical k-means, and a
+query is only compared with the vectors in the `nprobe` clusters whose centroids are closest to
+it. Increasing `nprobe` improves recall at the expense of speed.
+
+Indexes are built for, and attached to, a `VectorSpaceModel`, and are saved in a `.ivf.npz` file
+next to the model file, from where they are loaded automatically along with the model:
+
+>>> model = VectorSpaceModel.load('/path/to/models/1987.bin')
+>>> index = model.build_index(nlist=1024, nprobe=16)
+>>> model.most_similar('reagan')
+
+To choose a value for `nprobe`, `recall_report` compares the index with an exact search:
+
+>>> for row in recall_report(model, nprobes=[1, 4, 16, 64]):
+...     print(row)
+
+"""
+
+import time
+
+import numpy as np
+
+from .models import top_k, unit_vectors
+from . import debug
+
+
+class IVFIndex(object):
+
+    """An inverted-file index over a matrix of unit-length vectors.
+
+    The index stores the cluster centroids and, for each cluster, the rows of the vectors that
+    belong to it (as one array `order` of row indices sorted by cluster, with cluster `i` spanning
+    `order[offsets[i]:offsets[i+1]]`). The vectors themselves are not part of the index.
+
+    """
+
+    def __init__(self, centroids, order, offsets, nprobe=8):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+        return
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @property
+    def nvectors(self):
+        return self.order.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.centroids.nbytes + self.order.nbytes + self.offsets.nbytes
+
+    @classmethod
+    def build(cls, vectors, nlist=None, nprobe=8, niter=10, trainsize=None, seed=0,
+              batchsize=65536):
+        """Build an index for the unit-length row vectors in `vectors`.
+
+        ::param nlist:: the number of clusters (defaults to 4 * sqrt(number of vectors))
+        ::param nprobe:: the default number of clusters searched per query
+        ::param niter:: the number of k-means iterations
+        ::param trainsize:: the number of vectors sampled to train the centroids (defaults to
+            64 per cluster)
+        ::param seed:: the seed for the sampling and the initial centroids
+        ::returns:: an `IVFIndex`
+        """
+        n = vectors.shape[0]
+        if nlist is None:
+            nlist = int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n))
+        if trainsize is None:
+            trainsize = 64 * nlist
+        rng = np.random.RandomState(seed)
+        sample = np.sort(rng.choice(n, min(n, trainsize), replace=False))
+        train = np.asarray(vectors[sample], dtype=np.float32)
+        debug("Training {:,} centroids on {:,} vectors", nlist, train.shape[0])
+        centroids = train[rng.choice(train.shape[0], nlist, replace=False)].copy()
+        for _ in range(niter):
+            assign = _assign(train, centroids, batchsize)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                # Restart empty clusters from random training vectors.
+                sums[empty] = train[rng.choice(train.shape[0], empty.sum())]
+            centroids = unit_vectors(sums)
+        debug("Assigning {:,} vectors to {:,} clusters", n, nlist)
+        assign = _assign(vectors, centroids, batchsize)
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        return cls(centroids, order, offsets, nprobe=nprobe)
+
+    def search(self, vectors, queries, k=10, nprobe=None, limit=None, normalize=False):
+        """Find the approximate `k` nearest neighbours of each query.
+
+        ::param vectors:: the unit-length vectors that the index was built for (or, if
+            `normalize` is True, the raw vectors, of which only the searched rows are normalised)
+        ::param queries:: a matrix of query vectors (one per row)
+        ::param nprobe:: the number of clusters to search (defaults to `self.nprobe`)
+        ::param limit:: if given, only rows before `limit` are searched
+        ::returns:: a tuple of two `(len(queries), k)` arrays: the row indices of the neighbours
+            and their cosine similarities. If fewer than `k` vectors are searched, the missing
+            entries have index -1 and similarity -inf.
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        nprobe = max(1, min(nprobe, self.nlist))
+        queries = unit_vectors(np.atleast_2d(queries))
+        lists = top_k(np.dot(queries, self.centroids.T), nprobe)
+        indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            rows = np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]]
+                                   for l in lists[i]])
+            if limit is not None:
+                rows = rows[rows < limit]
+            if rows.shape[0] == 0:
+                continue
+            candidates = unit_vectors(vectors[rows]) if normalize else vectors[rows]
+            sims = np.dot(candidates, query)
+            best = top_k(sims[np.newaxis, :], k)[0]
+            indices[i, :len(best)] = rows[best]
+            scores[i, :len(best)] = sims[best]
+        return indices, scores
+
+    def save(self, filename):
+        debug("Saving index to file {:}", filename)
+        with open(filename, "wb") as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                     nprobe=self.nprobe)
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        debug("Loading index from file {:}", filename)
+        with np.load(filename) as data:
+            return cls(data["centroids"], data["order"], data["offsets"], int(data["nprobe"]))
+
+    def __repr__(self):
+        return "<IVFIndex with {:,} lists over {:,} vectors>".format(self.nlist, self.nvectors)
+
+
+def _assign(vectors, centroids, batchsize):
+    """Return the index of the closest centroid to each vector."""
+    assign = np.empty(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], batchsize):
+        batch = np.asarray(vectors[start:start + batchsize], dtype=np.float32)
+        assign[start:start + batchsize] = np.argmax(np.dot(batch, centroids.T), axis=1)
+    return assign
+
+
+def recall_report(model, nprobes=(1, 2, 4, 8, 16, 32, 64), k=10, nqueries=1000, seed=0):
+    """Measure the recall and speed of the index of `model` against an exact search.
+
+    The queries are the vectors of `nqueries` randomly sampled words of the model. For each value
+    of `nprobe`, recall is the fraction of the exact `k` nearest neighbours that are found by the
+    index.
+
+    ::returns:: a list of dicts with the keys `nprobe`, `recall`, `ms_per_query` and
+        `exact_ms_per_query`, one per value of `nprobe`.
+    """
+    if model.index is None:
+        raise ValueError("Model {:} has no index.".format(model.name))
+    vectors = model.syn0norm
+    rng = np.random.RandomState(seed)
+    queries = vectors[np.sort(rng.choice(len(model), min(nqueries, len(model)), replace=False))]
+    t0 = time.time()
+    exact = np.concatenate([top_k(np.dot(queries[i:i + 256], vectors.T), k)
+                            for i in range(0, queries.shape[0], 256)])
+    exact_ms = 1000.0 * (time.time() - t0) / queries.shape[0]
+    report = []
+    for nprobe in nprobes:
+        t0 = time.time()
+        found, _ = model.index.search(vectors, queries, k=k, nprobe=nprobe)
+        ms = 1000.0 * (time.time() - t0) / queries.shape[0]
+        hits = sum(len(np.intersect1d(e, f)) for e, f in zip(exact, found))
+        report.append({
+            "nprobe": nprobe,
+            "recall": hits / float(exact.size),
+            "ms_per_query": ms,
+            "exact_ms_per_query": exact_ms,
+        })
+    return report
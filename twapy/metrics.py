@@ -0,0 +1,153 @@
+"""Lightweight timing instrumentation of the stages of twapy.
+
+The main stages of the code (loading models, finding the common vocabulary of two models, fitting
+regressions, transforming vectors and searching for nearest neighbours) are timed with `timer` or
+`timed`, as the stages "load", "common_vocab", "fit", "transform" and "search". The number of calls
+and the total, and maximum, time of each stage are recorded in a `Metrics` registry. The module-level functions use the default registry:
+
+>>> from twapy import metrics
+>>> metrics.summary()
+{'fit': {'count': 1, 'seconds': 0.52, 'max_seconds': 0.52}, ...}
+>>> print(metrics.prometheus_text())
+
+The timings of a single run can be collected with `scope`:
+
+>>> with metrics.scope() as run:
+...     evaluation.evaluate_all()
+>>> print(run.format_summary())
+
+`Evaluation` runs log the summary of their own timings when they finish, and the web server
+serves the metrics in the Prometheus text format from its /metrics endpoint.
+
+"""
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics(object):
+
+    """A thread-safe registry of the number of calls and the durations of named stages.
+
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._scopes = []
+        self._lock = threading.Lock()
+        return
+
+    def record(self, stage, seconds, count=1):
+        """Record `count` calls of `stage` that took `seconds` in total."""
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = [0, 0.0, 0.0]
+            stats[0] += count
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds / max(count, 1))
+            scopes = list(self._scopes)
+        for scope in scopes:
+            scope.record(stage, seconds, count)
+        return
+
+    @contextmanager
+    def scope(self):
+        """A context manager that yields a new `Metrics` registry, which receives everything that
+        is recorded in (or merged into) this registry while the block runs. This gives the
+        timings of one run, e.g. of an evaluation, rather than of the whole process."""
+        scope = Metrics()
+        with self._lock:
+            self._scopes.append(scope)
+        try:
+            yield scope
+        finally:
+            with self._lock:
+                self._scopes.remove(scope)
+
+    @contextmanager
+    def timer(self, stage):
+        """A context manager that records the time spent in its block as one call of `stage`."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - t0)
+
+    def timed(self, stage):
+        """A decorator that records each call of the decorated function as a call of `stage`."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """Return a dict mapping each stage to its `count`, total `seconds` and `max_seconds`."""
+        with self._lock:
+            return {stage: {"count": count, "seconds": seconds, "max_seconds": longest}
+                    for stage, (count, seconds, longest) in self._stages.items()}
+
+    def merge(self, summary):
+        """Add the stages of a `summary()` (e.g. from another process) to this registry."""
+        with self._lock:
+            for stage, stats in summary.items():
+                current = self._stages.setdefault(stage, [0, 0.0, 0.0])
+                current[0] += stats["count"]
+                current[1] += stats["seconds"]
+                current[2] = max(current[2], stats["max_seconds"])
+            scopes = list(self._scopes)
+        for scope in scopes:
+            scope.merge(summary)
+        return
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+        return
+
+    def format_summary(self):
+        """Return the summary as a human-readable table."""
+        lines = ["{:<16s}{:>10s}{:>14s}{:>14s}{:>14s}".format(
+            "stage", "count", "total (s)", "mean (ms)", "max (ms)")]
+        for stage, stats in sorted(self.summary().items()):
+            lines.append("{:<16s}{:>10,d}{:>14.3f}{:>14.3f}{:>14.3f}".format(
+                stage, stats["count"], stats["seconds"],
+                1000.0 * stats["seconds"] / max(stats["count"], 1), 1000.0 * stats["max_seconds"]))
+        return "\n".join(lines)
+
+    def prometheus_text(self, prefix="twapy"):
+        """Return the metrics in the Prometheus text exposition format."""
+        summary = sorted(self.summary().items())
+        lines = [
+            "# HELP {:}_stage_seconds Time spent in each stage.".format(prefix),
+            "# TYPE {:}_stage_seconds summary".format(prefix),
+        ]
+        for stage, stats in summary:
+            lines.append('{:}_stage_seconds_count{{stage="{:}"}} {:d}'.format(
+                prefix, stage, stats["count"]))
+            lines.append('{:}_stage_seconds_sum{{stage="{:}"}} {:.6f}'.format(
+                prefix, stage, stats["seconds"]))
+        lines.append("# HELP {:}_stage_max_seconds Longest single call of each stage.".format(prefix))
+        lines.append("# TYPE {:}_stage_max_seconds gauge".format(prefix))
+        for stage, stats in summary:
+            lines.append('{:}_stage_max_seconds{{stage="{:}"}} {:.6f}'.format(
+                prefix, stage, stats["max_seconds"]))
+        return "\n".join(lines) + "\n"
+
+
+# The default registry, used by the module-level functions.
+registry = Metrics()
+record = registry.record
+timer = registry.timer
+scope = registry.scope
+timed = registry.timed
+summary = registry.summary
+merge = registry.merge
+reset = registry.reset
+format_summary = registry.format_summary
+prometheus_text = registry.prometheus_text
@@ -16,86 +16,577 @@ For example, below are two different ways of loading the 1987 model from disk:
 >>> model = collection['1987']
 >>> model = VectorSpaceModel.load('/path/to/models/1987.bin')
 
+Models can also be stored in a twapy-native format, which consists of a `.npy` matrix of vectors
+and a `.vocab` file listing the words. Native models are memory-mapped when they are loaded, which
+is much faster than parsing a word2vec file. To convert a word2vec model to the native format:
+
+>>> from twapy.models import convert_w2v
+>>> convert_w2v('/path/to/models/1987.bin')
+'/path/to/models/1987.npy'
+
 """
 
+import bisect
+import hashlib
+import json
 import os
 import pickle
 import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
 
 from twapy import info, debug, warn
+from . import metrics
+
+
+# Extensions of the two files that make up a model in the twapy-native format.
+NATIVE_EXTENSION = ".npy"
+NATIVE_VOCAB_EXTENSION = ".vocab"
+
+# Extension of the files of normalised vectors that can accompany native model files, so that
+# processes sharing a model also share its normalised vectors (see `save_native`).
+NORM_EXTENSION = ".norm.npy"
+
+# Extension of the approximate nearest-neighbour index files saved next to model files.
+INDEX_EXTENSION = ".ivf.npz"
 
+# Extensions of the files that `ModelCollection` treats as models.
+MODEL_EXTENSIONS = (".bin", ".txt", ".vec", ".txt.gz", ".vec.gz", NATIVE_EXTENSION, ".pkl")
 
-try:
-    from gensim.models import KeyedVectors
-except:
-    warn("Gensim import failed. Please ensure that gensim verison 2 or greater is installed.")
-    import sys
-    sys.exit(1)
+# Name of the manifest of the model files of a `ModelCollection`, in its `cache_dir`.
+MANIFEST_FILENAME = "manifest.json"
+
+# The number of rows of the normalised vectors scored at a time by exact searches, and the
+# number of threads that score them (by default, the number of CPUs).
+SEARCH_CHUNKSIZE = 65536
+SEARCH_WORKERS = None
 
 
 class VectorSpaceModel(object):
 
     """Base class for models that represent words as vectors.
 
-    For now, this really is just a wrapper around the Gensim KeyedVectors / Word2Vec class.
+    A model is a matrix of vectors (`syn0`) and a list of the words corresponding to its rows
+    (`index2word`). Models read from word2vec files are backed by a Gensim `KeyedVectors`
+    instance, which is available as the `m` attribute. Models read from the twapy-native format
+    (see `save_native`) are backed by a memory-mapped numpy array, and their `KeyedVectors` are
+    only built if `m` is accessed.
+
+    Nearest-neighbour searches are exact, unless an approximate index has been built with
+    `build_index` (or loaded from an index file next to the model file), in which case the index
+    is used for searches by vector. Alternatively, `quantize` compresses the normalised vectors,
+    and searches then score the compressed vectors and re-rank the best candidates exactly.
+
+    Models can be loaded with a `limit`, which only keeps the first (that is, in word2vec files,
+    the most frequent) `limit` words. Alternatively, all words can be loaded but searches
+    restricted to the first `restrict_vocab` words.
 
     """
 
-    def __init__(self, name=None):
+    def __init__(self, name=None, syn0=None, index2word=None):
         self.name = name
-        self.m = KeyedVectors()
+        self.filename = None
+        self.index = None
+        self.quantized = None
+        self.rerank = 4
+        self.restrict_vocab = None
+        self.file_hash = None
+        self._m = None
+        self._vocab = None
+        self._fingerprint = None
+        self._syn0norm = None
+        self.syn0 = syn0
+        self.index2word = index2word
+        return
+
+    @property
+    def m(self):
+        """The Gensim `KeyedVectors` instance for this model."""
+        if self._m is None:
+            self._m = _keyed_vectors(self.syn0, self.index2word)
+        return self._m
+
+    @m.setter
+    def m(self, m):
+        self._m = m
+        self._vocab = None
+        self._fingerprint = None
+        self.file_hash = None
+        self._syn0norm = None
+        self.syn0 = m.syn0
+        self.index2word = m.index2word
         return
 
+    @property
+    def vocab(self):
+        """A dict mapping each word in the model to its row in `syn0`."""
+        if self._vocab is None:
+            self._vocab = dict(zip(self.index2word, range(len(self.index2word))))
+        return self._vocab
+
+    @property
+    def vector_size(self):
+        return self.syn0.shape[1]
+
+    @property
+    def fingerprint(self):
+        """A hash of the contents (words and vectors) of the model. This identifies the model
+        independently of its name, and is computed once and then remembered.
+
+        If the model was loaded by a `ModelCollection`, the content hash of its file (from the
+        `ModelManifest`) stands in for the vectors, so the vectors are not read again to hash
+        them.
+        """
+        if self._fingerprint is None:
+            h = hashlib.sha1()
+            h.update("\n".join(self.index2word).encode("utf-8"))
+            h.update(str(self.syn0.shape).encode("ascii"))
+            file_hash = getattr(self, "file_hash", None)
+            if file_hash is not None:
+                h.update(file_hash.encode("ascii"))
+            else:
+                chunk = max(1, (1 << 24) // max(1, self.syn0.itemsize * self.syn0.shape[1]))
+                for i in range(0, self.syn0.shape[0], chunk):
+                    h.update(np.ascontiguousarray(self.syn0[i:i + chunk]).data)
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
     @classmethod
+    @metrics.timed("load")
     def load(cls, filename, modelname=None, **kwargs):
+        """Load a model from a word2vec, native or pickle file.
+
+        ::param limit:: if given, only the first `limit` words of the model are loaded.
+        ::param restrict_vocab:: if given, searches are restricted to the first `restrict_vocab`
+            words of the model.
+        """
+        restrict_vocab = kwargs.pop("restrict_vocab", None)
         if filename.endswith('.pkl'):
             model = cls.load_pickle(filename, modelname=modelname, **kwargs)
+        elif filename.endswith(NATIVE_EXTENSION):
+            model = cls.load_native(filename, modelname=modelname, **kwargs)
         else:
             model = cls.load_w2v(filename, modelname=modelname, **kwargs)
+        model.filename = filename
+        model.restrict_vocab = restrict_vocab
+        # An index older than the model file was built for a previous version of the model.
+        if (os.path.exists(model.index_filename) and
+                os.path.getmtime(model.index_filename) >= os.path.getmtime(filename)):
+            model.load_index()
         return model
 
     @classmethod
-    def load_pickle(cls, filename, **kwargs):
-        debug("Loading pickled model from file {:}".format(filename))
-        model = pickle.load(filename)
+    def load_pickle(cls, filename, modelname=None, limit=None, **kwargs):
+        debug("Loading pickled model from file {:}", filename)
+        with open(filename, "rb") as f:
+            model = pickle.load(f)
+        if modelname is not None:
+            model.name = modelname
+        if limit is not None and len(model) > limit:
+            model = cls(name=model.name, syn0=model.syn0[:limit],
+                        index2word=model.index2word[:limit])
         return model
 
     @classmethod
-    def load_w2v(cls, filename, modelname=None, **kwargs):
-        """Load the model from disk."""
-        debug("Loading word2vec model from file {:}".format(filename))
-        if filename.endswith(".bin"):
-            m = KeyedVectors.load_word2vec_format(filename, binary=True)
-        else:
-            m = KeyedVectors.load_word2vec_format(filename)
+    def load_w2v(cls, filename, modelname=None, limit=None, workers=None, **kwargs):
+        """Load the model from disk.
+
+        Binary (`.bin`) files are read with Gensim. Text files, which may be gzipped, are read
+        with `twapy.textformat`, which parses them in chunks, in `workers` processes.
+        """
+        debug("Loading word2vec model from file {:}", filename)
+        if modelname is None:
+            modelname = _model_name(os.path.basename(filename))
+        if not filename.endswith(".bin"):
+            from .textformat import read_text_vectors
+            index2word, syn0 = read_text_vectors(filename, limit=limit, workers=workers)
+            return cls(name=modelname, syn0=syn0, index2word=index2word)
+        KeyedVectors, _ = _import_gensim()
+        m = KeyedVectors.load_word2vec_format(filename, binary=True, limit=limit)
         model = cls()
         model.m = m
-        if modelname is None:
-            modelname = os.path.basename(filename)
-            modelname = re.sub('.bin', '', modelname)
         model.name = modelname
         return model
 
+    @classmethod
+    def load_native(cls, filename, modelname=None, mmap_mode='r', limit=None, **kwargs):
+        """Load a model saved in the twapy-native format.
+
+        The vectors are opened as a memory-mapped array (unless `mmap_mode` is None), so loading
+        is almost instantaneous and the vectors are paged in from disk as they are used. Processes
+        that open the same file share the same physical pages. If the model was saved with its
+        normalised vectors, they are memory-mapped too.
+        """
+        debug("Loading native model from file {:}", filename)
+        syn0 = np.load(filename, mmap_mode=mmap_mode)
+        if limit is not None:
+            syn0 = syn0[:limit]
+        with open(native_vocab_filename(filename), encoding="utf-8") as f:
+            if limit is None:
+                index2word = f.read().split("\n")[:syn0.shape[0]]
+            else:
+                index2word = [line.rstrip("\n") for line in islice(f, syn0.shape[0])]
+        if len(index2word) != syn0.shape[0]:
+            raise ValueError("Vocabulary file for {:} has {:,} words but the matrix has {:,} rows"
+                             .format(filename, len(index2word), syn0.shape[0]))
+        if modelname is None:
+            modelname = os.path.splitext(os.path.basename(filename))[0]
+        model = cls(name=modelname, syn0=syn0, index2word=index2word)
+        if os.path.exists(norm_filename(filename)):
+            syn0norm = np.load(norm_filename(filename), mmap_mode=mmap_mode)[:syn0.shape[0]]
+            if syn0norm.shape == syn0.shape:
+                model.syn0norm = syn0norm
+        return model
+
+    def save_native(self, filename, normalized=False):
+        """Save the model in the twapy-native format.
+
+        This writes the vectors as a contiguous float32 `.npy` matrix to `filename`, and the
+        vocabulary (one word per line, in row order) to a `.vocab` file alongside it. If
+        `normalized` is True, the normalised vectors are also written, to a `.norm.npy` file, so
+        that they are memory-mapped by `load_native` rather than computed by each process.
+        """
+        if not filename.endswith(NATIVE_EXTENSION):
+            filename += NATIVE_EXTENSION
+        debug("Saving model {:} to native file {:}", self.name, filename)
+        np.save(filename, np.ascontiguousarray(self.syn0, dtype=np.float32))
+        if normalized:
+            np.save(norm_filename(filename), self.syn0norm)
+        with open(native_vocab_filename(filename), "w", encoding="utf-8") as f:
+            f.write("\n".join(self.index2word))
+        return filename
+
     def save_pickle(self, filename):
-        debug("Saving model {:} to pickle file {:}".format(self.name, filename))
-        pickle.dump(self, filename)
+        debug("Saving model {:} to pickle file {:}", self.name, filename)
+        with open(filename, "wb") as f:
+            pickle.dump(self, f)
         return
 
     def __getitem__(self, word):
-        return(self.m[word])
+        if self._m is not None:
+            return self._m[word]
+        return self.syn0[self.vocab[word]]
+
+    def __contains__(self, word):
+        return word in self.vocab
+
+    def __len__(self):
+        return self.syn0.shape[0]
 
-    def most_similar(self, query, k=5):
+    @property
+    def nbytes(self):
+        """The number of bytes of memory used by the vectors of the model. Memory-mapped vectors
+        are not counted, since their pages belong to the OS page cache and are shared between
+        processes."""
+        nbytes = 0
+        if self.syn0 is not None and not isinstance(self.syn0, np.memmap):
+            nbytes += self.syn0.nbytes
+        if self._syn0norm is not None and not isinstance(self._syn0norm, np.memmap):
+            nbytes += self._syn0norm.nbytes
+        if self.quantized is not None:
+            nbytes += self.quantized.nbytes
+        if self.index is not None:
+            nbytes += self.index.nbytes
+        return nbytes
+
+    def quantize(self, dtype="int8", rerank=4):
+        """Compress the normalised vectors of the model to `dtype` ("int8" or "float16"), and
+        use them for nearest-neighbour searches. The `topn * rerank` best candidates of each
+        search are re-ranked with the full-precision vectors. The full-precision normalised
+        vectors are released."""
+        from .quantize import QuantizedMatrix
+        self.quantized = QuantizedMatrix.from_vectors(self.syn0, dtype=dtype)
+        self.rerank = rerank
+        self._syn0norm = None
+        return self.quantized
+
+    @property
+    def syn0norm(self):
+        """The vectors of the model scaled to unit length. This is computed once, when it is
+        first needed."""
+        if self._syn0norm is None:
+            debug("Normalising {:,} vectors of {:}", len(self), self.name)
+            self._syn0norm = unit_vectors(self.syn0)
+        return self._syn0norm
+
+    @syn0norm.setter
+    def syn0norm(self, syn0norm):
+        self._syn0norm = syn0norm
+        return
+
+    @metrics.timed("search")
+    def similar_by_vectors(self, vectors, topn=5, batchsize=256, exact=False, nprobe=None,
+                           restrict_vocab=None):
+        """Return the `topn` most similar words to each row of `vectors`, as a list (one item per
+        row) of lists of `(word, similarity)` tuples.
+
+        The search is exact (see `exact_search`): the normalised vectors of the model are scored
+        in chunks of rows, in parallel threads, and queries are processed `batchsize` at a time,
+        so the memory used for scores is bounded. If the model has an index and `exact` is
+        False, the index is searched instead, and otherwise if the model has been quantised and
+        `exact` is False, the quantised vectors are searched.
+
+        Only the first `restrict_vocab` words (by default, `self.restrict_vocab`) are searched.
+        """
+        queries = unit_vectors(np.atleast_2d(vectors))
+        if restrict_vocab is None:
+            restrict_vocab = self.restrict_vocab
+        limit = len(self) if restrict_vocab is None else min(restrict_vocab, len(self))
+        if self.index is not None and not exact:
+            # A quantised model has released its normalised vectors, so only the candidate rows
+            # of the raw vectors are normalised.
+            normalize = self._syn0norm is None and self.quantized is not None
+            indices, scores = self.index.search(self.syn0 if normalize else self.syn0norm,
+                                                queries, k=topn, nprobe=nprobe, limit=limit,
+                                                normalize=normalize)
+            return [[(self.index2word[i], float(s)) for i, s in zip(idx, sims) if i >= 0]
+                    for idx, sims in zip(indices, scores)]
+        if self.quantized is not None and not exact:
+            results = []
+            for start in range(0, queries.shape[0], batchsize):
+                indices, scores = self.quantized.search(self.syn0, queries[start:start + batchsize],
+                                                        k=topn, rerank=self.rerank, limit=limit)
+                results.extend([(self.index2word[i], float(s)) for i, s in zip(idx, sims)]
+                               for idx, sims in zip(indices, scores))
+            return results
+        syn0norm = self.syn0norm
+        results = []
+        for start in range(0, queries.shape[0], batchsize):
+            indices, scores = exact_search(syn0norm, queries[start:start + batchsize], k=topn,
+                                           limit=limit)
+            results.extend([(self.index2word[i], float(s)) for i, s in zip(idx, sims)]
+                           for idx, sims in zip(indices, scores))
+        return results
+
+    def most_similar(self, query, k=5, topn=None, exact=False, nprobe=None, restrict_vocab=None):
         """Return the most similar words to the query. `query` can be either a string or a
-        vector. If it is a string, then its vector will be looked up in the current VSM.
+        vector. If it is a string, then its vector will be looked up in the current VSM, and the
+        word itself is left out of the results.
+
+        If the model has an index, it is used unless `exact` is True. `nprobe` overrides the
+        default number of clusters searched by the index. `restrict_vocab` restricts the search
+        to the first `restrict_vocab` words of the model.
         """
+        if topn is not None:
+            k = topn
         if type(query) is str:
-            results = self.m.most_similar(query, topn=k)
+            results = self.similar_by_vectors(self[query], topn=k + 1, exact=exact, nprobe=nprobe,
+                                              restrict_vocab=restrict_vocab)[0]
+            results = [r for r in results if r[0] != query][:k]
         else:
-            results = self.m.similar_by_vector(query, topn=k)
+            results = self.similar_by_vectors(query, topn=k, exact=exact, nprobe=nprobe,
+                                              restrict_vocab=restrict_vocab)[0]
         return results
 
+    @property
+    def index_filename(self):
+        """The file in which the index of this model is saved."""
+        if self.filename is None:
+            return None
+        return index_filename(self.filename)
+
+    def build_index(self, nlist=None, nprobe=8, save=True, **kwargs):
+        """Build an approximate nearest-neighbour index (an `IVFIndex`) for this model. If `save`
+        is True and the model was loaded from a file, the index is saved next to it.
+
+        See `IVFIndex.build` for the remaining arguments.
+        """
+        from .index import IVFIndex
+        debug("Building index for model {:}", self.name)
+        self.index = IVFIndex.build(self.syn0norm, nlist=nlist, nprobe=nprobe, **kwargs)
+        if save and self.filename is not None:
+            self.index.save(self.index_filename)
+        return self.index
+
+    def load_index(self, filename=None):
+        """Load the index of this model from `filename` (by default, from `index_filename`)."""
+        from .index import IVFIndex
+        index = IVFIndex.load(filename or self.index_filename)
+        if index.nvectors != len(self):
+            warn("Ignoring index of {:}: it covers {:,} vectors but the model has {:,}",
+                 self.name, index.nvectors, len(self))
+            return None
+        self.index = index
+        return index
+
     def __repr__(self):
-        return "<VectorSpaceModel {:} with {:,} vectors>".format(repr(self.name), self.m.syn0.shape[0])
+        return "<VectorSpaceModel {:} with {:,} vectors>".format(repr(self.name), self.syn0.shape[0])
+
+
+def unit_vectors(vectors):
+    """Return a float32 copy of `vectors` with each row scaled to unit length. Rows of zeros are
+    left as zeros."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+    norms[norms == 0] = 1.0
+    return vectors / norms[:, np.newaxis]
+
+
+def top_k(scores, k):
+    """Return the column indices of the `k` largest scores in each row of `scores`, sorted by
+    decreasing score."""
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=1), axis=1)
+    return np.take_along_axis(idx, order, axis=1)
+
+
+def exact_search(vectors, queries, k=10, limit=None, chunksize=None, workers=None):
+    """Find the exact `k` nearest neighbours of each (unit-length) query among the unit-length
+    row vectors in `vectors`.
+
+    The rows are scored in chunks of `chunksize` rows (by default, `SEARCH_CHUNKSIZE`), so at most
+    `workers * len(queries) * chunksize` scores are held in memory at once. The chunks are shared
+    out between `workers` tasks (by default, `SEARCH_WORKERS`, or the number of CPUs, and no more
+    than the number of chunks), which run in a thread pool shared by all searches, since numpy
+    releases the GIL for matrix products. Each task keeps the running top `k` of its chunks, and
+    the results of the tasks are merged at the end.
+
+    ::param limit:: if given, only rows before `limit` are searched
+    ::returns:: a tuple of two `(len(queries), k)` arrays: the row indices of the neighbours and
+        their cosine similarities, sorted by decreasing similarity.
+    """
+    queries = np.atleast_2d(queries)
+    n = vectors.shape[0] if limit is None else min(limit, vectors.shape[0])
+    k = min(k, n)
+    if k <= 0:
+        return (np.empty((queries.shape[0], 0), dtype=np.int64),
+                np.empty((queries.shape[0], 0), dtype=np.float32))
+    if chunksize is None:
+        chunksize = SEARCH_CHUNKSIZE
+    starts = list(range(0, n, chunksize))
+    workers = min(len(starts), workers or SEARCH_WORKERS or os.cpu_count() or 1)
+
+    def search_chunks(worker):
+        best = None
+        for start in starts[worker::workers]:
+            stop = min(start + chunksize, n)
+            scores = np.dot(queries, vectors[start:stop].T)
+            indices = top_k(scores, k)
+            found = (indices + start, np.take_along_axis(scores, indices, axis=1))
+            best = found if best is None else _merge_top_k(best, found, k)
+        return best
+
+    if workers <= 1:
+        results = [search_chunks(0)]
+    else:
+        results = list(_search_pool().map(search_chunks, range(workers)))
+    best = results[0]
+    for found in results[1:]:
+        best = _merge_top_k(best, found, k)
+    return best
+
+
+def _merge_top_k(a, b, k):
+    """Merge two `(indices, scores)` results into the top `k` of both."""
+    indices = np.concatenate([a[0], b[0]], axis=1)
+    scores = np.concatenate([a[1], b[1]], axis=1)
+    best = top_k(scores, k)
+    return np.take_along_axis(indices, best, axis=1), np.take_along_axis(scores, best, axis=1)
+
+
+_search_executor = None
+_search_executor_lock = threading.Lock()
+
+
+def _search_pool():
+    """Return the thread pool shared by all exact searches. It is created once, with
+    `SEARCH_WORKERS` (or the number of CPUs) threads, and never replaced, since other searches
+    may be using it; searches that ask for more workers queue their extra tasks."""
+    global _search_executor
+    with _search_executor_lock:
+        if _search_executor is None:
+            _search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS or os.cpu_count() or 1,
+                                                  thread_name_prefix="twapy-search")
+        return _search_executor
+
+
+def _reset_search_pool():
+    """Forget the search pool in a forked child process, whose copy of the pool has no threads
+    (but believes that it has idle ones)."""
+    global _search_executor, _search_executor_lock
+    _search_executor = None
+    _search_executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_search_pool)
+
+
+def index_filename(filename):
+    """Return the name of the index file that accompanies the model file `filename`."""
+    return os.path.splitext(filename)[0] + INDEX_EXTENSION
+
+
+def norm_filename(filename):
+    """Return the name of the normalised vectors file that accompanies the native model
+    `filename`."""
+    return os.path.splitext(filename)[0] + NORM_EXTENSION
+
+
+def native_vocab_filename(filename):
+    """Return the name of the vocabulary file that accompanies the native model `filename`."""
+    return os.path.splitext(filename)[0] + NATIVE_VOCAB_EXTENSION
+
+
+def convert_w2v(filename, output=None, **kwargs):
+    """Convert a word2vec model (`.bin` or text format) to the twapy-native format.
+
+    ::param filename:: the word2vec file to convert
+    ::param output:: the native model file to write (defaults to `filename` with a `.npy` extension)
+    ::returns:: the name of the native model file that was written
+    """
+    if output is None:
+        output = re.sub(r"\.(bin|txt|vec)(\.gz)?$", "", filename) + NATIVE_EXTENSION
+    if filename.endswith(".bin"):
+        model = VectorSpaceModel.load_w2v(filename, **kwargs)
+        return model.save_native(output)
+    # Text files are parsed straight into the memory-mapped output matrix.
+    from .textformat import read_text_vectors
+    if not output.endswith(NATIVE_EXTENSION):
+        output += NATIVE_EXTENSION
+    index2word, _ = read_text_vectors(filename, output=output, **kwargs)
+    with open(native_vocab_filename(output), "w", encoding="utf-8") as f:
+        f.write("\n".join(index2word))
+    return output
+
+
+def _import_gensim():
+    """Import Gensim on first use, as it is slow to import and only needed for word2vec files and
+    the `m` attribute of models: native models are handled with numpy alone.
+
+    ::returns:: the `KeyedVectors` and `Vocab` classes
+    """
+    try:
+        from gensim.models import KeyedVectors
+        from gensim.models.keyedvectors import Vocab
+    except ImportError:
+        raise ImportError("Gensim is needed to read word2vec files. Please ensure that gensim "
+                          "version 2 or greater is installed, or convert the models to the native "
+                          "format (see `convert_w2v`).")
+    return KeyedVectors, Vocab
+
+
+def _keyed_vectors(syn0, index2word):
+    """Build a Gensim `KeyedVectors` instance that shares the given vector matrix."""
+    KeyedVectors, Vocab = _import_gensim()
+    m = KeyedVectors()
+    if syn0 is None:
+        return m
+    n = len(index2word)
+    m.vocab = {word: Vocab(index=i, count=n - i) for i, word in enumerate(index2word)}
+    m.index2word = index2word
+    m.vector_size = syn0.shape[1]
+    m.syn0 = syn0
+    return m
 
 
 # class Word2VecModel(VectorSpaceModel):
@@ -140,6 +631,317 @@ class VectorSpaceModel(object):
 #         return
 #
 
+# Default memory budget for the models that a `ModelCollection` keeps loaded (2 GiB).
+DEFAULT_CACHE_BYTES = 2 * 1024 ** 3
+
+
+class ModelCache(object):
+
+    """A least-recently-used cache of loaded models with a memory budget.
+
+    The size of each model is taken from its `nbytes`, which is measured again every time the
+    budget is checked (on `get` and `put`), so the normalised and quantised vectors and the index
+    that a model builds after it was cached are counted too. When the total size of the cached
+    models exceeds `max_bytes`, models are evicted in least-recently-used order until the cache
+    fits the budget again. The most recently added model is never evicted, so a single model
+    larger than the budget is still kept until something else is loaded. If `max_bytes` is None
+    the cache is unbounded.
+
+    The cache keeps `hits`, `misses` and `evictions` counters, which are summarised by `stats()`.
+
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        return
+
+    @staticmethod
+    def model_nbytes(model):
+        """Return the number of bytes used by the vectors of `model` (see
+        `VectorSpaceModel.nbytes`)."""
+        return getattr(model, "nbytes", 0)
+
+    def get(self, key):
+        """Return the cached model for `key`, or None if it is not cached."""
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                self.misses += 1
+                return None
+            self._models.move_to_end(key)
+            self.hits += 1
+            self._evict()
+            return model
+
+    def put(self, key, model):
+        """Add `model` to the cache, evicting older models if the budget is exceeded."""
+        size = self.model_nbytes(model)
+        with self._lock:
+            if key in self._models:
+                self.nbytes -= self._sizes.pop(key)
+                del self._models[key]
+            self._models[key] = model
+            self._sizes[key] = size
+            self.nbytes += size
+            self._evict()
+        return
+
+    def discard(self, key):
+        """Remove `key` from the cache if present."""
+        with self._lock:
+            if key in self._models:
+                del self._models[key]
+                self.nbytes -= self._sizes.pop(key)
+        return
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+        return
+
+    def _measure(self):
+        """Measure the size of each cached model again."""
+        for key, model in self._models.items():
+            size = self.model_nbytes(model)
+            self.nbytes += size - self._sizes[key]
+            self._sizes[key] = size
+        return
+
+    def _evict(self):
+        self._measure()
+        if self.max_bytes is None:
+            return
+        while self.nbytes > self.max_bytes and len(self._models) > 1:
+            key, _ = self._models.popitem(last=False)
+            self.nbytes -= self._sizes.pop(key)
+            self.evictions += 1
+            debug("Evicted model {:} from the model cache", key)
+        return
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+    def stats(self):
+        """Return a dict summarising the state of the cache."""
+        with self._lock:
+            self._measure()
+        return {
+            "models": len(self._models),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __repr__(self):
+        return "<ModelCache with {:d} models, {:,} bytes>".format(len(self._models), self.nbytes)
+
+
+class GlobalVocabulary(object):
+
+    """A single word-id space shared by all of the models in a `ModelCollection`.
+
+    The global vocabulary is the sorted union of the vocabularies of all the models. For each
+    model, an int32 array maps every global id to the row of that word in the model (or -1 if the
+    model does not contain the word). The words that two models have in common are then found
+    with a vectorised mask over the two arrays, instead of intersecting sets of strings.
+
+    The vocabulary can be saved to a directory, along with the path and content hash of each
+    model file it was built from, and is rebuilt when it is loaded if any model file has changed.
+    `words_of` recovers the vocabulary of a model from the global vocabulary, so a rebuild only
+    needs to read the models that have changed.
+
+    """
+
+    def __init__(self, words, maps, sources=None):
+        self.words = words
+        self.maps = maps
+        self.sources = sources or {}
+        self._word_ids = None
+        return
+
+    @classmethod
+    def build(cls, words, sources=None):
+        """Build the global vocabulary from `words`, a dict mapping each model name to the list
+        (or array) of words of that model, in row order."""
+        debug("Building global vocabulary of {:d} models", len(words))
+        # The words are kept as Python strings: fixed-width numpy string arrays would take the
+        # size of the longest word for every word.
+        allwords = sorted(set().union(*words.values()))
+        word_ids = dict(zip(allwords, range(len(allwords))))
+        maps = {}
+        for name, modelwords in words.items():
+            ids = np.fromiter((word_ids[word] for word in modelwords), dtype=np.int64,
+                              count=len(modelwords))
+            mapping = np.full(len(allwords), -1, dtype=np.int32)
+            mapping[ids] = np.arange(len(modelwords), dtype=np.int32)
+            maps[name] = mapping
+        debug("{:,} words in the global vocabulary", len(allwords))
+        vocabulary = cls(allwords, maps, sources)
+        vocabulary._word_ids = word_ids
+        return vocabulary
+
+    @property
+    def word_ids(self):
+        """A dict mapping each word to its global id."""
+        if self._word_ids is None:
+            self._word_ids = dict(zip(self.words, range(len(self.words))))
+        return self._word_ids
+
+    def words_of(self, modelname):
+        """Return the array of the words of a model, in row order."""
+        mapping = self.maps[modelname]
+        ids = np.flatnonzero(mapping >= 0)
+        words = np.empty(len(ids), dtype=object)
+        words[mapping[ids]] = np.array(self.words, dtype=object)[ids]
+        return words
+
+    def common_rows(self, modelname1, modelname2):
+        """Return the rows `(rows1, rows2)` of the words that two models have in common, in the
+        same order as `twapy.alignment.common_rows`. The end-of-sentence token `</s>` is left
+        out."""
+        with metrics.timer("common_vocab"):
+            return self._common_rows(modelname1, modelname2)
+
+    def _common_rows(self, modelname1, modelname2):
+        map1 = self.maps[modelname1]
+        map2 = self.maps[modelname2]
+        mask = (map1 >= 0) & (map2 >= 0)
+        # The global words are sorted, so the id of a word can be found by bisection.
+        eos = bisect.bisect_left(self.words, "</s>")
+        if eos < len(self.words) and self.words[eos] == "</s>":
+            mask[eos] = False
+        return map1[mask], map2[mask]
+
+    def save(self, directory):
+        """Save the vocabulary to a `vocabulary.npz` file in `directory`. The file is written
+        under a temporary name and then renamed, so readers never see a partial file."""
+        debug("Saving global vocabulary to {:}", directory)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        words = np.frombuffer("\n".join(self.words).encode("utf-8"), dtype=np.uint8)
+        fd, tmp = tempfile.mkstemp(suffix=".npz", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, sources=json.dumps(self.sources), words=words,
+                         **{"map:" + name: mapping for name, mapping in self.maps.items()})
+            os.replace(tmp, os.path.join(directory, "vocabulary.npz"))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return
+
+    @classmethod
+    def load(cls, directory):
+        """Load a global vocabulary from `directory`, or return None if there is none."""
+        fn = os.path.join(directory, "vocabulary.npz")
+        if not os.path.exists(fn):
+            return None
+        debug("Loading global vocabulary from {:}", directory)
+        with np.load(fn) as data:
+            if "words" not in data.files:
+                return None
+            sources = json.loads(str(data["sources"]))
+            maps = {key[4:]: data[key] for key in data.files if key.startswith("map:")}
+            text = data["words"].tobytes().decode("utf-8")
+        words = text.split("\n") if text else []
+        return cls(words, maps, sources)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __repr__(self):
+        return "<GlobalVocabulary of {:,} words in {:d} models>".format(len(self), len(self.maps))
+
+
+class ModelManifest(object):
+
+    """The manifest of the model files in a directory.
+
+    For each model, the manifest records the path, size, modification time and content hash
+    (SHA-1) of its file, and the vocabulary size and vector size read from the file header. It is
+    saved as JSON in the cache directory of a `ModelCollection`. A new scan of the directory reuses
+    the entries of the files whose size and modification time have not changed, so only new and
+    modified files are hashed.
+
+    """
+
+    def __init__(self, entries=None):
+        self.entries = OrderedDict(entries or {})
+        return
+
+    @classmethod
+    def load(cls, directory):
+        """Load the manifest saved in `directory`, or return an empty manifest."""
+        fn = os.path.join(directory, MANIFEST_FILENAME) if directory is not None else None
+        if fn is None or not os.path.exists(fn):
+            return cls()
+        with open(fn, encoding="utf-8") as f:
+            return cls(json.load(f)["models"])
+
+    def save(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fn = os.path.join(directory, MANIFEST_FILENAME)
+        tmp = fn + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"models": self.entries}, f, indent=1)
+        os.replace(tmp, fn)
+        return fn
+
+    def scan(self, directory):
+        """Return a new manifest of the model files in `directory`."""
+        entries = OrderedDict()
+        for fn in _model_files(directory):
+            path = os.path.join(directory, fn)
+            stat = os.stat(path)
+            modelname = _model_name(fn)
+            entry = self.entries.get(modelname)
+            if (entry is None or entry["path"] != path or entry["size"] != stat.st_size or
+                    entry["mtime"] != stat.st_mtime):
+                debug("Adding model file {:} to the manifest", path)
+                vocab_size, dim = _model_shape(path)
+                entry = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime,
+                         "hash": file_hash(path), "vocab_size": vocab_size, "dim": dim}
+            entries[modelname] = entry
+        return ModelManifest(entries)
+
+    def diff(self, other):
+        """Return the lists of the names of the models that are `added`, `changed` and `removed`
+        in the manifest `other` compared to this one."""
+        added = [name for name in other.entries if name not in self.entries]
+        removed = [name for name in self.entries if name not in other.entries]
+        changed = [name for name in other.entries if name in self.entries and
+                   (self.entries[name]["path"], self.entries[name]["hash"]) !=
+                   (other.entries[name]["path"], other.entries[name]["hash"])]
+        return added, changed, removed
+
+    def __getitem__(self, modelname):
+        return self.entries[modelname]
+
+    def __contains__(self, modelname):
+        return modelname in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "<ModelManifest of {:d} models>".format(len(self))
+
+
 class ModelCollection(object):
 
     """Collection of vector space models.
@@ -147,13 +949,42 @@ class ModelCollection(object):
     This can be instantiated from a directory containing multiple vector space models. This class
     facilitates any operations that involve more than one vector space model.
 
+    Models that are lazy-loaded from disk are kept in a `ModelCache`, so that repeated lookups of
+    the same model do not re-read the model file. The memory budget of the cache is given by
+    `cache_bytes` (None for no limit).
+
+    The collection also has a `GlobalVocabulary`, which is saved in `cache_dir` (by default, the
+    `.twapy` subdirectory of the model directory), and an `AlignmentRegistry` of the alignments
+    between its models (`alignments`), which is used by `trajectory`.
+
+    `limit` and `restrict_vocab` are passed to `VectorSpaceModel.load` when models are loaded.
+
+    The model files of the directory are recorded in a `ModelManifest`, which is saved in
+    `cache_dir`. `refresh` scans the directory again and only reloads the models whose files are
+    new or have changed, invalidating what depends on them.
+
     """
 
-    def __init__(self, directory=None, lazy=True):
+    def __init__(self, directory=None, lazy=True, cache_bytes=DEFAULT_CACHE_BYTES,
+                 cache_dir=None, limit=None, restrict_vocab=None):
 
         self._models = {}
-        self._directory = None
+        self._directory = directory
         self._lazy = lazy
+        self.limit = limit
+        self.restrict_vocab = restrict_vocab
+        self._vocabulary = None
+        self._vocabulary_checked = False
+        self._alignments = None
+        self._stack = None
+        self.manifest = ModelManifest()
+        self.cache = ModelCache(max_bytes=cache_bytes)
+        self._lock = threading.Lock()
+        self._model_locks = {}
+        self._vocabulary_lock = threading.RLock()
+        if cache_dir is None and directory is not None:
+            cache_dir = os.path.join(directory, ".twapy")
+        self.cache_dir = cache_dir
 
         if directory is not None:
             self._load_directory(directory, lazy=lazy)
@@ -172,8 +1003,12 @@ class ModelCollection(object):
                         break
                     i += 1
         if modelname in self._models.keys():
-            warn("Overwriting existing model '{:}'.".format(modelname))
+            warn("Overwriting existing model '{:}'.", modelname)
+            self.cache.discard(modelname)
         self._models[modelname] = model
+        self._vocabulary = None
+        self._vocabulary_checked = False
+        self._stack = None
         return
 
     def _load_directory(self, directory, lazy=True):
@@ -184,30 +1019,327 @@ class ModelCollection(object):
         on-demand as needed. This is very useful (actually, essential) when working with
         directories containing many models.
         '''
-        debug("Loading models from directory {:}".format(directory))
-        for fn in sorted(os.listdir(directory)):
-            fpath = os.path.join(directory, fn)
-            modelname = fn.rsplit(".", 1)[0]
-            if lazy:
-                debug("Lazy-loaded model from file {:}".format(fn))
-                model = fpath
-            else:
-                try:
-                    debug("Loaded model from file {:}".format(fn))
-                    model = load_model(fpath, lazy=lazy)
-                except:
-                    warn("Unable to load model from file {:}".format(fn))
-                    model = None
-            self._models[modelname] = model
-        debug("Loaded {:d} models: {:}".format(len(self._models), list(self._models.keys())))
+        debug("Loading models from directory {:}", directory)
+        previous = ModelManifest.load(self.cache_dir)
+        self.manifest = previous.scan(directory)
+        if self.manifest.entries != previous.entries:
+            self._save_manifest()
+        for modelname in self.manifest.entries:
+            self._models[modelname] = self._load_entry(modelname, lazy)
+        debug("Loaded {:d} models: {:}", len(self._models), list(self._models.keys()))
+        return
+
+    def _load_entry(self, modelname, lazy):
+        """Return the model of a manifest entry: its path if `lazy`, and otherwise the model."""
+        path = self.manifest[modelname]["path"]
+        if lazy:
+            debug("Lazy-loaded model from file {:}", path)
+            return path
+        try:
+            model = self._load_model(modelname)
+            debug("Loaded model from file {:}", path)
+            return model
+        except Exception:
+            warn("Unable to load model from file {:}", path)
+            return None
+
+    def _save_manifest(self):
+        if self.cache_dir is None:
+            return
+        try:
+            self.manifest.save(self.cache_dir)
+        except OSError as e:
+            warn("Unable to save the model manifest to {:}: {:}", self.cache_dir, e)
+        return
+
+    def refresh(self):
+        """Scan the model directory again, and update the collection with the model files that
+        have been added, changed or removed since the last scan.
+
+        Only new and changed files are hashed and (when they are next used) loaded. The models of
+        changed and removed files are dropped from the model cache, along with their alignments
+        in `alignments` and the global vocabulary (which is rebuilt from the new and changed
+        models only). Indexes of changed models are rebuilt, with the same settings.
+
+        ::returns:: a dict with the lists of the names of the models that are "added", "changed"
+            and "removed".
+        """
+        if self._directory is None:
+            return {"added": [], "changed": [], "removed": []}
+        manifest = self.manifest.scan(self._directory)
+        added, changed, removed = self.manifest.diff(manifest)
+        if added or changed or removed:
+            info("Models added: {:}, changed: {:}, removed: {:}", added, changed, removed)
+        modified = manifest.entries != self.manifest.entries
+        stale_indexes = [name for name in changed
+                         if os.path.exists(index_filename(manifest[name]["path"]))]
+        for modelname in changed + removed:
+            self.cache.discard(modelname)
+            self._models.pop(modelname, None)
+            if self._alignments is not None:
+                self._alignments.discard(modelname)
+        self.manifest = manifest
+        for modelname in added + changed:
+            self._models[modelname] = self._load_entry(modelname, self._lazy)
+        if added or changed or removed:
+            self._vocabulary = None
+            self._vocabulary_checked = False
+            self._stack = None
+        if modified:
+            self._save_manifest()
+        for modelname in stale_indexes:
+            self._rebuild_index(modelname)
+        return {"added": added, "changed": changed, "removed": removed}
+
+    def _rebuild_index(self, modelname):
+        """Rebuild the index of a model whose file has changed, with the settings of its previous
+        index."""
+        from .index import IVFIndex
+        model = self[modelname]
+        previous = IVFIndex.load(index_filename(self.manifest[modelname]["path"]))
+        info("Rebuilding the index of model {:}", modelname)
+        model.build_index(nlist=previous.nlist, nprobe=previous.nprobe)
         return
 
     def __getitem__(self, modelname):
         model = self._models[modelname]
         if type(model) == str:
-            model = VectorSpaceModel.load(filename=model, modelname=modelname)
+            # Concurrent requests for a model that is being loaded wait for that load instead of
+            # loading the model again.
+            with self._model_lock(modelname):
+                cached = self.cache.get(modelname)
+                if cached is not None:
+                    return cached
+                model = self._load_model(modelname, model)
+                self.cache.put(modelname, model)
         return model
 
+    def _load_model(self, modelname, path=None):
+        """Load a model of the manifest (or from `path`), with the file hash of the manifest as
+        the basis of its fingerprint."""
+        if path is None:
+            path = self.manifest[modelname]["path"]
+        model = VectorSpaceModel.load(filename=path, modelname=modelname, limit=self.limit,
+                                      restrict_vocab=self.restrict_vocab)
+        if modelname in self.manifest and self.manifest[modelname]["path"] == path:
+            model.file_hash = self.manifest[modelname]["hash"]
+        return model
+
+    def _model_lock(self, modelname):
+        """Return the lock that serialises the loads of the model `modelname`."""
+        with self._lock:
+            lock = self._model_locks.get(modelname)
+            if lock is None:
+                lock = self._model_locks[modelname] = threading.Lock()
+            return lock
+
     @property
     def modelnames(self):
         return sorted(self._models.keys())
+
+    def _sources(self):
+        """Return the path and content hash of the file of each lazy-loaded model, and the limit
+        that it is loaded with."""
+        sources = {}
+        for modelname, model in self._models.items():
+            if type(model) == str and modelname in self.manifest:
+                entry = self.manifest[modelname]
+                sources[modelname] = [entry["path"], entry["hash"], self.limit]
+            else:
+                sources[modelname] = None
+        return sources
+
+    @property
+    def vocabulary(self):
+        """The `GlobalVocabulary` of the collection. It is loaded from `cache_dir` if it is up to
+        date, and otherwise built and saved there. Building it loads the models whose files are
+        not in the saved vocabulary (on the first build, every model) once. Concurrent requests
+        wait for a build that is in progress."""
+        with self._vocabulary_lock:
+            return self._build_vocabulary()
+
+    def _build_vocabulary(self):
+        if self._vocabulary is None:
+            sources = self._sources()
+            vocabulary, previous = self._load_vocabulary(sources)
+            if vocabulary is None:
+                words = {}
+                for name in self.modelnames:
+                    if previous is not None and previous.sources.get(name) == sources[name]:
+                        words[name] = previous.words_of(name)
+                    else:
+                        words[name] = self[name].index2word
+                vocabulary = GlobalVocabulary.build(words, sources)
+                if self.cache_dir is not None and None not in sources.values():
+                    try:
+                        vocabulary.save(self.cache_dir)
+                    except OSError as e:
+                        warn("Unable to save the global vocabulary to {:}: {:}",
+                             self.cache_dir, e)
+            self._vocabulary = vocabulary
+        return self._vocabulary
+
+    def _load_vocabulary(self, sources):
+        """Load the saved global vocabulary from `cache_dir`.
+
+        ::returns:: a tuple `(vocabulary, previous)`: the vocabulary if it is up to date (and
+            otherwise None), and the out-of-date vocabulary, if any
+        """
+        if self.cache_dir is None or None in sources.values():
+            return None, None
+        vocabulary = GlobalVocabulary.load(self.cache_dir)
+        if vocabulary is not None and vocabulary.sources != sources:
+            debug("Global vocabulary is out of date")
+            return None, vocabulary
+        return vocabulary, None
+
+    def common_rows(self, modelname1, modelname2):
+        """Return the rows `(rows1, rows2)` of the words that two models have in common.
+
+        These are found with the global vocabulary if it has been built, or is saved and up to
+        date, and otherwise from the vocabularies of the two models alone, so that aligning one
+        pair of models does not load every model of the collection.
+        """
+        with self._vocabulary_lock:
+            if self._vocabulary is None and not self._vocabulary_checked:
+                # Only look for a saved vocabulary once (until the models change).
+                self._vocabulary = self._load_vocabulary(self._sources())[0]
+                self._vocabulary_checked = True
+            vocabulary = self._vocabulary
+        if vocabulary is not None:
+            return vocabulary.common_rows(modelname1, modelname2)
+        from .alignment import common_rows
+        return common_rows(self[modelname1], self[modelname2])
+
+    @property
+    def alignments(self):
+        """The `AlignmentRegistry` of this collection. A registry with the default alignment
+        settings is created when this is first used, unless one has been assigned."""
+        if self._alignments is None:
+            from .alignment import AlignmentRegistry
+            self._alignments = AlignmentRegistry(self)
+        return self._alignments
+
+    @alignments.setter
+    def alignments(self, registry):
+        self._alignments = registry
+        return
+
+    def normalized_stack(self, modelnames):
+        """Return a 3D array stacking the normalised vectors of the given models, with shape
+        `(number of models, largest vocabulary, vector size)`, and an array of the vocabulary
+        size of each model. Models with smaller vocabularies are padded with rows of zeros.
+
+        The stack of the last list of models that was requested is kept. It needs as much memory
+        as the normalised vectors of all the models together.
+        """
+        key = tuple(modelnames)
+        if self._stack is None or self._stack[0] != key:
+            models = [self[modelname] for modelname in modelnames]
+            lengths = np.array([len(model) for model in models])
+            debug("Stacking the vectors of {:d} models", len(models))
+            stack = np.zeros((len(models), lengths.max(), models[0].vector_size),
+                             dtype=np.float32)
+            for i, model in enumerate(models):
+                stack[i, :lengths[i]] = model.syn0norm
+            self._stack = (key, stack, lengths)
+        return self._stack[1], self._stack[2]
+
+    def trajectory(self, word, source, targets=None, topn=1, stacked=False):
+        """Find the analogues of `word` from the model `source` in each of the `targets` models
+        (by default, all of the other models in the collection).
+
+        The vector of the word is transformed into all of the target spaces at once, by stacking
+        the transformations of the alignments from `source` to each target. If `stacked` is
+        True, the similarities in all of the targets are then computed in one operation over the
+        `normalized_stack` of the targets; otherwise each target is searched in turn (which uses
+        the index of the target model if it has one).
+
+        ::returns:: an `OrderedDict` mapping each target model name to the list of the `topn`
+            `(word, similarity)` analogues in that model.
+        """
+        if targets is None:
+            targets = [modelname for modelname in self.modelnames if modelname != source]
+        targets = list(targets)
+        vector = self[source][word]
+        regressions = [self.alignments.get(source, target).regression for target in targets]
+        coefs = [regression.coef_ for regression in regressions]
+        if len(set(coef.shape for coef in coefs)) == 1:
+            queries = np.einsum("tij,j->ti", np.stack(coefs), vector)
+            queries += np.stack([regression.intercept_ for regression in regressions])
+        else:
+            queries = np.stack([regression.predict(vector[np.newaxis, :])[0]
+                                for regression in regressions])
+        trajectory = OrderedDict()
+        if stacked:
+            stack, lengths = self.normalized_stack(targets)
+            scores = np.einsum("tvd,td->tv", stack, unit_vectors(queries))
+            # Mask the padding rows, and the rows beyond the `restrict_vocab` of each target, as
+            # `similar_by_vectors` does not search them.
+            limits = lengths.copy()
+            for t, target in enumerate(targets):
+                if self[target].restrict_vocab is not None:
+                    limits[t] = min(limits[t], self[target].restrict_vocab)
+            scores[np.arange(stack.shape[1])[np.newaxis, :] >= limits[:, np.newaxis]] = -np.inf
+            for target, row, indices in zip(targets, scores, top_k(scores, topn)):
+                index2word = self[target].index2word
+                trajectory[target] = [(index2word[i], float(row[i])) for i in indices
+                                      if row[i] > -np.inf]
+        else:
+            for target, query in zip(targets, queries):
+                trajectory[target] = self[target].similar_by_vectors(query, topn=topn)[0]
+        return trajectory
+
+
+def _model_files(directory):
+    """List the model files in `directory`.
+
+    Only files with one of the `MODEL_EXTENSIONS` are listed. Hidden files, subdirectories and the
+    normalised vectors files of native models are skipped. If a model exists both in the native
+    format and in another format, only the native file is listed.
+    """
+    files = {}
+    for fn in sorted(os.listdir(directory)):
+        if fn.startswith(".") or fn.endswith(NORM_EXTENSION) or not fn.endswith(MODEL_EXTENSIONS):
+            continue
+        if not os.path.isfile(os.path.join(directory, fn)):
+            continue
+        modelname = _model_name(fn)
+        if modelname in files and not fn.endswith(NATIVE_EXTENSION):
+            continue
+        files[modelname] = fn
+    return sorted(files.values())
+
+
+def _model_name(fn):
+    """Return the name of the model in the file `fn` (the file name without its extension, and
+    without a `.gz` extension if it is compressed)."""
+    if fn.endswith(".gz"):
+        fn = fn[:-len(".gz")]
+    return fn.rsplit(".", 1)[0]
+
+
+def file_hash(filename, blocksize=1 << 24):
+    """Return the SHA-1 hash of the contents of a file."""
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _model_shape(filename):
+    """Return the vocabulary size and vector size of a model file, from its header, or `(None,
+    None)` if the file has no header that can be read without loading the model."""
+    try:
+        if filename.endswith(NATIVE_EXTENSION):
+            shape = np.load(filename, mmap_mode="r").shape
+            return int(shape[0]), int(shape[1])
+        if not filename.endswith(".pkl"):
+            from .textformat import open_text
+            with open_text(filename) as f:
+                vocab_size, dim = f.readline().split()
+            return int(vocab_size), int(dim)
+    except (ValueError, OSError):
+        pass
+    return None, None
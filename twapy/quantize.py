@@ -0,0 +1,112 @@
+"""Compressed storage of the normalised vectors of a model.
+
+A `QuantizedMatrix` holds the unit-length vectors of a model either as float16 values, or as int8
+codes with one float32 scale per row, which needs a half or a quarter of the memory of the
+float32 vectors. Nearest-neighbour searches score the query against the compressed matrix, and
+then re-rank the best candidates with the full-precision vectors, so the results are the same as
+an exact search unless a true neighbour falls outside the candidates.
+
+To compress a model:
+
+>>> model = VectorSpaceModel.load('/path/to/models/1987.npy')
+>>> model.quantize('int8')
+>>> model.most_similar('reagan')
+
+The full-precision vectors are only read for the candidates, so with a memory-mapped native model
+only the compressed matrix needs to stay in memory.
+
+"""
+
+import numpy as np
+
+from .models import _merge_top_k, top_k, unit_vectors
+from . import debug
+
+
+class QuantizedMatrix(object):
+
+    """A matrix of unit-length row vectors stored as float16, or as int8 with per-row scales.
+
+    """
+
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+        return
+
+    @classmethod
+    def from_vectors(cls, vectors, dtype="int8", batchsize=65536):
+        """Compress `vectors` (which are normalised first) to `dtype` ("int8" or "float16")."""
+        if dtype not in ("int8", "float16"):
+            raise ValueError("Unknown quantisation type '{:}'".format(dtype))
+        debug("Quantising {:,} vectors to {:}", vectors.shape[0], dtype)
+        codes = np.empty(vectors.shape, dtype=dtype)
+        scales = np.empty(vectors.shape[0], dtype=np.float32) if dtype == "int8" else None
+        for start in range(0, vectors.shape[0], batchsize):
+            batch = unit_vectors(vectors[start:start + batchsize])
+            if dtype == "int8":
+                scale = np.abs(batch).max(axis=1) / 127.0
+                scale[scale == 0] = 1.0
+                codes[start:start + batchsize] = np.rint(batch / scale[:, np.newaxis])
+                scales[start:start + batchsize] = scale
+            else:
+                codes[start:start + batchsize] = batch
+        return cls(codes, scales)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def scores(self, queries, batchsize=65536, limit=None):
+        """Return the approximate dot products of each (normalised) query with each row (or with
+        each of the first `limit` rows)."""
+        n = self.codes.shape[0] if limit is None else min(limit, self.codes.shape[0])
+        scores = np.empty((queries.shape[0], n), dtype=np.float32)
+        for start in range(0, n, batchsize):
+            stop = min(start + batchsize, n)
+            scores[:, start:stop] = self._block_scores(queries, start, stop)
+        return scores
+
+    def _block_scores(self, queries, start, stop):
+        """Return the approximate dot products of the queries with the rows `start:stop`, which
+        are decoded on their own to bound the temporary memory."""
+        block = np.dot(queries, self.codes[start:stop].astype(np.float32).T)
+        if self.scales is not None:
+            block *= self.scales[start:stop]
+        return block
+
+    def search(self, vectors, queries, k=10, rerank=4, limit=None, batchsize=65536):
+        """Find the `k` nearest neighbours of each query.
+
+        The compressed matrix is scored `batchsize` rows at a time, keeping the running `k *
+        rerank` best candidates (as in `exact_search`), and the candidates are then re-ranked with
+        their full-precision `vectors`. If `limit` is given, only the first `limit` rows are
+        searched.
+
+        ::returns:: a tuple of two `(len(queries), k)` arrays: the row indices of the neighbours
+            and their cosine similarities.
+        """
+        queries = unit_vectors(np.atleast_2d(queries))
+        n = self.codes.shape[0] if limit is None else min(limit, self.codes.shape[0])
+        k = min(k, n)
+        ncandidates = min(max(k * rerank, k), n)
+        best = None
+        for start in range(0, n if ncandidates > 0 else 0, batchsize):
+            stop = min(start + batchsize, n)
+            block = self._block_scores(queries, start, stop)
+            rows = top_k(block, ncandidates)
+            found = (rows + start, np.take_along_axis(block, rows, axis=1))
+            best = found if best is None else _merge_top_k(best, found, ncandidates)
+        candidates = best[0] if best is not None else np.empty((queries.shape[0], 0), np.int64)
+        indices = np.empty((queries.shape[0], k), dtype=np.int64)
+        scores = np.empty((queries.shape[0], k), dtype=np.float32)
+        for i, (query, rows) in enumerate(zip(queries, candidates)):
+            rows = np.sort(rows)
+            sims = np.dot(unit_vectors(vectors[rows]), query)
+            order = top_k(sims[np.newaxis, :], k)[0]
+            indices[i] = rows[order]
+            scores[i] = sims[order]
+        return indices, scores
+
+    def __repr__(self):
+        return "<QuantizedMatrix of {:,} {:} vectors>".format(self.codes.shape[0], self.codes.dtype)
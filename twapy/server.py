@@ -1,18 +1,143 @@
 """Twapy demo server. This is a basic Flask app to serve an index page and to solve analogies via
-GET requests to the /analogy/ endpoint.
+GET requests to the /analogy/ endpoint, or in batches via POST requests to the /analogies
+endpoint.
 
 To run the server locally, execute the runserver.bat or runserver.sh script.
 
+Alignments are kept in an `AlignmentRegistry`, so each pair of models is only aligned once, no
+matter how many requests (or threads) ask for it. The pairs in `preload_pairs` are aligned when
+the server starts.
+
+Analogies of words in a precomputed `AnalogyTable` of the alignment store (see `twapy.tables`) are
+looked up in the table rather than searched for:
+
+    python -m twapy.tables models alignments 1987 1997 --words twapy/static/vocab10k.json
+
+Solved analogies are kept in a `ResultCache` for `result_ttl` seconds. The hit and miss counts of
+the cache for each endpoint are reported by the /stats endpoint.
+
+To run several worker processes (e.g. with gunicorn) that share the memory of the models, export
+the models and the preloaded pairs once to a shared directory with `twapy.hosting`, and set the
+`TWAPY_SHARED_DIR` environment variable to that directory: the models and aligned models are then
+memory-mapped read-only from there by every worker.
+
+    python -m twapy.hosting models shared --pair 1987 1997
+    TWAPY_SHARED_DIR=shared gunicorn -w 4 twapy.server:app
+
+A POST request to /refresh rescans the model directory, so that new or changed models are served
+without a restart (see `ModelCollection.refresh`). It responds with the names of the models that
+were added, changed and removed.
+
+The /metrics endpoint serves, in the Prometheus text format, the timings of the stages of twapy
+(see `twapy.metrics`), the hits and misses of the result cache for each endpoint, and the state of
+the model cache.
+
+A request to /analogies has a JSON body with a list of queries, each either an object with the
+keys "model1", "model2" and "word", or a `[model1, model2, word]` list, and optionally "topn":
+
+    {"queries": [["1987", "1997", "reagan"], ["1987", "1997", "koch"]], "topn": 1}
+
+The response lists, for each query, the analogue "word2" and the "neighbors" (the `topn`
+analogues with their similarities), or an "error" message.
+
 """
 
-from flask import Flask, jsonify, render_template
+import os
+import threading
+import time
+from collections import OrderedDict
 
+from flask import Flask, Response, jsonify, render_template, request
+
+from . import metrics
 from .models import ModelCollection
-from .alignment import Analogy
+from .alignment import Analogy, AlignmentRegistry, AlignmentStore
+from .hosting import ALIGNMENT_SUBDIRECTORY
 
 # Set the directory containing the embedding models here:
 model_directory = "models"
+
+# Fitted alignments are saved in this directory and reused across requests and restarts:
+alignment_directory = "alignments"
+
+# A directory written by `twapy.hosting.export_models`, whose models and alignments are shared
+# by all worker processes:
+shared_directory = os.environ.get("TWAPY_SHARED_DIR")
+if shared_directory:
+    model_directory = shared_directory
+    alignment_directory = os.path.join(shared_directory, ALIGNMENT_SUBDIRECTORY)
+
 collection = ModelCollection(model_directory)
+store = AlignmentStore(alignment_directory)
+
+# Pairs of models to align at startup, e.g. [("1987", "1997")], and the maximum number of
+# alignments to keep in memory:
+preload_pairs = []
+max_alignments = 64
+registry = AlignmentRegistry(collection, store=store, maxsize=max_alignments)
+# Use the registry as the collection's, so that `collection.refresh` drops stale alignments.
+collection.alignments = registry
+registry.preload(preload_pairs)
+
+
+class ResultCache(object):
+
+    """A thread-safe, bounded cache of results that expire after `ttl` seconds.
+
+    When the cache holds more than `maxsize` results, the least recently used are dropped. Hits
+    and misses are counted separately for each endpoint.
+
+    """
+
+    def __init__(self, maxsize=100000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        return
+
+    def get(self, key, endpoint):
+        """Return the cached result for `key`, or None."""
+        with self._lock:
+            item = self._results.get(key)
+            if item is not None and item[0] < time.time():
+                del self._results[key]
+                item = None
+            if item is None:
+                self.misses[endpoint] = self.misses.get(endpoint, 0) + 1
+                return None
+            self._results.move_to_end(key)
+            self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+            return item[1]
+
+    def put(self, key, result):
+        with self._lock:
+            self._results[key] = (time.time() + self.ttl, result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        return
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+        return
+
+    def stats(self):
+        endpoints = sorted(set(self.hits) | set(self.misses))
+        return {
+            "size": len(self._results),
+            "endpoints": {e: {"hits": self.hits.get(e, 0), "misses": self.misses.get(e, 0)}
+                          for e in endpoints},
+        }
+
+
+# Maximum number of solved analogies to keep, and how long to keep them (in seconds):
+max_results = 100000
+result_ttl = 3600
+results = ResultCache(maxsize=max_results, ttl=result_ttl)
 
 app = Flask(__name__)
 
@@ -25,9 +150,112 @@ def home():
 @app.route('/analogy/<model1>/<model2>/<word>')
 def analogy(model1, model2, word):
     # Calculate the analogy result
-    a = Analogy(word, model1, model2, collection=collection)
+    key = (model1, model2, word)
+    word2 = results.get(key, "analogy")
+    if word2 is None:
+        word2 = Analogy(word, alignment=registry.get(model1, model2)).word2
+        results.put(key, word2)
     obj = {
         "message": "Word {:} mapped from {:} to {:}".format(word, model1, model2),
-        "word2": a.word2
+        "word2": word2
     }
     return jsonify(obj)
+
+
+def parse_analogy_queries(body):
+    """Return the `(queries, topn)` of the body of an /analogies request, where `queries` is a
+    list of `(model1, model2, word)` tuples. A ValueError is raised if the body is malformed."""
+    if not isinstance(body, dict):
+        raise ValueError("The request body must be a JSON object")
+    try:
+        topn = int(body.get("topn", 1))
+    except (TypeError, ValueError):
+        raise ValueError("topn must be an integer")
+    if topn < 1:
+        raise ValueError("topn must be at least 1")
+    if not isinstance(body.get("queries", []), list):
+        raise ValueError("queries must be a list")
+    queries = []
+    for query in body.get("queries", []):
+        if isinstance(query, dict):
+            query = (query.get("model1"), query.get("model2"), query.get("word"))
+        if not isinstance(query, (list, tuple)) or len(query) != 3 or None in query:
+            raise ValueError("Each query must be a [model1, model2, word] list or an object with "
+                             "model1, model2 and word keys")
+        queries.append(tuple(str(q) for q in query))
+    return queries, topn
+
+
+@app.route('/analogies', methods=['POST'])
+def analogies():
+    try:
+        queries, topn = parse_analogy_queries(request.get_json(force=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    answers = [None] * len(queries)
+    # Look up the cached results and group the remaining queries by pair of models.
+    pending = OrderedDict()
+    for i, (model1, model2, word) in enumerate(queries):
+        answers[i] = results.get((model1, model2, word, topn), "analogies")
+        if answers[i] is None:
+            pending.setdefault((model1, model2), []).append(i)
+    for (model1, model2), indices in pending.items():
+        try:
+            alignment = registry.get(model1, model2)
+        except KeyError:
+            for i in indices:
+                answers[i] = {"error": "Unknown model"}
+            continue
+        words = [queries[i][2] for i in indices]
+        for i, neighbors in zip(indices, alignment.analogies(words, topn=topn)):
+            if neighbors is None:
+                answers[i] = {"error": "Word not in model {:}".format(model1)}
+            else:
+                answers[i] = {"word2": neighbors[0][0], "neighbors": neighbors}
+                results.put(queries[i] + (topn,), answers[i])
+    obj = {"results": [dict(answer, model1=q[0], model2=q[1], word=q[2])
+                       for q, answer in zip(queries, answers)]}
+    return jsonify(obj)
+
+
+@app.route('/refresh', methods=['POST'])
+def refresh():
+    changes = collection.refresh()
+    if changes["changed"] or changes["removed"]:
+        results.clear()
+    return jsonify(changes)
+
+
+@app.route('/stats')
+def stats():
+    obj = {
+        "results": results.stats(),
+        "models": collection.cache.stats(),
+        "alignments": len(registry),
+    }
+    return jsonify(obj)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    lines = [metrics.prometheus_text().rstrip("\n")]
+    result_stats = results.stats()
+    for name, kind in (("hits", "Result cache hits"), ("misses", "Result cache misses")):
+        lines.append("# HELP twapy_result_cache_{:}_total {:} per endpoint.".format(name, kind))
+        lines.append("# TYPE twapy_result_cache_{:}_total counter".format(name))
+        for endpoint, counts in sorted(result_stats["endpoints"].items()):
+            lines.append('twapy_result_cache_{:}_total{{endpoint="{:}"}} {:d}'.format(
+                name, endpoint, counts[name]))
+    lines.append("# TYPE twapy_result_cache_size gauge")
+    lines.append("twapy_result_cache_size {:d}".format(result_stats["size"]))
+    model_stats = collection.cache.stats()
+    for name, kind in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                       ("models", "gauge"), ("nbytes", "gauge"), ("max_bytes", "gauge")):
+        suffix = "_total" if kind == "counter" else ""
+        # A cache without a memory budget (max_bytes None) has an infinite limit.
+        value = "+Inf" if model_stats[name] is None else "{:d}".format(model_stats[name])
+        lines.append("# TYPE twapy_model_cache_{:}{:} {:}".format(name, suffix, kind))
+        lines.append("twapy_model_cache_{:}{:} {:}".format(name, suffix, value))
+    lines.append("# TYPE twapy_alignments gauge")
+    lines.append("twapy_alignments {:d}".format(len(registry)))
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
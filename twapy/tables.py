@@ -0,0 +1,245 @@
+"""Precomputed tables of analogies.
+
+For the pairs of models that are queried the most, the analogues of a list of words can be
+computed in advance, so that solving an analogy is a table lookup rather than a nearest-neighbour
+search. `precompute` solves the analogies of the words in blocks, in parallel threads, and writes
+an `AnalogyTable` to a directory. Each block is saved as soon as it is solved, so an interrupted
+run resumes from the blocks that are missing.
+
+An `AnalogyTable` maps the row of each word in the first model to the rows and similarities of its
+`topn` analogues in the second model. Its arrays are saved as `.npy` files and memory-mapped when
+they are loaded, so a lookup only reads one row of each, and processes share their pages.
+
+Tables are normally kept in an `AlignmentStore` next to the alignment they were computed from, and
+alignments that use the store answer `analogies` (and `Analogy` instances) from the table when it
+contains the word:
+
+>>> alignment = Alignment('1987', '1997', collection=collection, store=store)
+>>> alignment.precompute(collection['1987'].index2word[:10000], topn=10, workers=4)
+>>> Analogy('reagan', alignment=alignment).word2
+'clinton'
+
+Tables can also be computed from the command line, e.g. for the words of the web interface:
+
+    python -m twapy.tables models alignments 1987 1997 --words twapy/static/vocab10k.json
+
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import debug, info
+
+
+class AnalogyTable(object):
+
+    """A table of the precomputed analogues of words of `model1` in `model2`.
+
+    `slots` has one entry per row of `model1`: the row of the word in `neighbors` and `scores`, or
+    -1 if the word is not in the table. `neighbors` holds the rows in `model2` of the analogues of
+    each word, in decreasing order of similarity, and `scores` their similarities.
+
+    """
+
+    def __init__(self, slots, neighbors, scores, model1=None, model2=None):
+        self.slots = slots
+        self.neighbors = neighbors
+        self.scores = scores
+        self.model1 = model1
+        self.model2 = model2
+        return
+
+    @property
+    def topn(self):
+        return self.neighbors.shape[1]
+
+    def slot(self, word):
+        """Return the row of `word` in the table, or -1 if it is not in the table."""
+        row = self.model1.vocab.get(word) if isinstance(word, str) else None
+        if row is None or row >= self.slots.shape[0]:
+            return -1
+        return int(self.slots[row])
+
+    def lookup(self, word, topn=None):
+        """Return the `topn` (by default, all) analogues of `word` as a list of `(word,
+        similarity)` tuples, or None if the word is not in the table. Words with fewer analogues
+        than the table has columns are padded with row -1, which is skipped."""
+        slot = self.slot(word)
+        if slot < 0:
+            return None
+        topn = self.topn if topn is None else min(topn, self.topn)
+        index2word = self.model2.index2word
+        return [(index2word[row], float(score))
+                for row, score in zip(self.neighbors[slot, :topn], self.scores[slot, :topn])
+                if row >= 0]
+
+    def save(self, dirname):
+        """Save the table to the directory `dirname`, replacing any previous table there. The
+        table is written to a temporary directory first, so readers never see a partial table."""
+        parent = os.path.dirname(os.path.abspath(dirname))
+        tmp = tempfile.mkdtemp(prefix=".table-", dir=parent)
+        np.save(os.path.join(tmp, "slots.npy"), np.asarray(self.slots, dtype=np.int32))
+        np.save(os.path.join(tmp, "neighbors.npy"), np.asarray(self.neighbors, dtype=np.int32))
+        np.save(os.path.join(tmp, "scores.npy"), np.asarray(self.scores, dtype=np.float32))
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmp, dirname)
+        return dirname
+
+    @classmethod
+    def load(cls, dirname, model1, model2, mmap_mode="r"):
+        debug("Loading analogy table from {:}", dirname)
+        arrays = [np.load(os.path.join(dirname, name + ".npy"), mmap_mode=mmap_mode)
+                  for name in ("slots", "neighbors", "scores")]
+        return cls(*arrays, model1=model1, model2=model2)
+
+    def __len__(self):
+        return self.neighbors.shape[0]
+
+    def __contains__(self, word):
+        return self.slot(word) >= 0
+
+    def __repr__(self):
+        return "<AnalogyTable of {:,} words with {:d} analogues each>".format(len(self), self.topn)
+
+
+def precompute(alignment, words, dirname, topn=10, blocksize=1024, workers=1):
+    """Solve the analogies of `words` with `alignment`, and save them as an `AnalogyTable` in the
+    directory `dirname`.
+
+    The words are solved in blocks of `blocksize` words, by `workers` threads (the searches are
+    numpy matrix products, which release the GIL). Each block is saved to the `.parts`
+    directory next to `dirname` as soon as it is solved, and the blocks that are already there are
+    not solved again, so an interrupted run can be restarted. The parts are removed once the table
+    is saved. Words with fewer than `topn` analogues (e.g. if model2 has a smaller
+    `restrict_vocab`, or an index search finds fewer candidates) are padded with row -1 and
+    similarity -inf.
+
+    ::param words:: a list of words, or a number `k` for the first `k` words of model1. Words that
+        are not in model1 are left out.
+    ::returns:: the `AnalogyTable`
+    """
+    model1, model2 = alignment.model1, alignment.model2
+    if isinstance(words, int):
+        words = model1.index2word[:words]
+    vocab = model1.vocab
+    # Drop duplicates (keeping the first occurrence) and unknown words.
+    words = [word for word in dict.fromkeys(words) if word in vocab]
+    width = min(topn, len(model2))
+    partsdir = dirname.rstrip(os.sep) + ".parts"
+    _prepare_parts(partsdir, words, topn)
+    starts = [start for start in range(0, len(words), blocksize)
+              if not os.path.exists(_part_filename(partsdir, start))]
+    info("Precomputing {:,} analogies with {:} ({:,} of {:,} blocks left)", len(words),
+         alignment.name, len(starts), (len(words) + blocksize - 1) // blocksize)
+
+    def solve_block(start):
+        block = words[start:start + blocksize]
+        results = alignment.analogies(block, topn=topn, use_table=False)
+        vocab2 = model2.vocab
+        neighbors = np.full((len(block), width), -1, dtype=np.int32)
+        scores = np.full((len(block), width), -np.inf, dtype=np.float32)
+        for i, result in enumerate(results):
+            result = result[:width]
+            neighbors[i, :len(result)] = [vocab2[w] for w, _ in result]
+            scores[i, :len(result)] = [s for _, s in result]
+        rows = np.array([vocab[word] for word in block], dtype=np.int32)
+        fd, tmp = tempfile.mkstemp(suffix=".npz", dir=partsdir)
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, rows=rows, neighbors=neighbors, scores=scores)
+        os.replace(tmp, _part_filename(partsdir, start))
+        return start
+
+    if workers is None or workers <= 1:
+        for start in starts:
+            solve_block(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(solve_block, starts):
+                pass
+    slots = np.full(len(model1), -1, dtype=np.int32)
+    neighbors = np.empty((len(words), width), dtype=np.int32)
+    scores = np.empty(neighbors.shape, dtype=np.float32)
+    for start in range(0, len(words), blocksize):
+        with np.load(_part_filename(partsdir, start)) as part:
+            stop = start + part["rows"].shape[0]
+            slots[part["rows"]] = np.arange(start, stop, dtype=np.int32)
+            neighbors[start:stop] = part["neighbors"]
+            scores[start:stop] = part["scores"]
+    table = AnalogyTable(slots, neighbors, scores, model1=model1, model2=model2)
+    table.save(dirname)
+    shutil.rmtree(partsdir)
+    return table
+
+
+def _prepare_parts(partsdir, words, topn):
+    """Create the directory of the parts of a table, and clear any parts left by a run with a
+    different word list or `topn`."""
+    ident = hashlib.sha1(json.dumps([topn, words]).encode("utf-8")).hexdigest()
+    identfile = os.path.join(partsdir, "words.sha1")
+    if os.path.exists(partsdir):
+        previous = None
+        if os.path.exists(identfile):
+            with open(identfile) as f:
+                previous = f.read()
+        if previous == ident:
+            return
+        shutil.rmtree(partsdir)
+    os.makedirs(partsdir)
+    with open(identfile, "w") as f:
+        f.write(ident)
+    return
+
+
+def _part_filename(partsdir, start):
+    return os.path.join(partsdir, "{:010d}.npz".format(start))
+
+
+def read_words(filename):
+    """Read a word list from a JSON list (like `static/vocab10k.json`) or a text file with one
+    word per line."""
+    with open(filename, encoding="utf-8") as f:
+        if filename.endswith(".json"):
+            return json.load(f)
+        return [line.strip() for line in f if line.strip()]
+
+
+def main(argv=None):
+    from . import configure_logging
+    from .models import ModelCollection
+    from .alignment import Alignment, AlignmentStore
+    parser = argparse.ArgumentParser(description="Precompute a table of analogies for a pair of "
+                                                 "models.")
+    parser.add_argument("models_dir")
+    parser.add_argument("alignment_dir")
+    parser.add_argument("model1")
+    parser.add_argument("model2")
+    parser.add_argument("--words", default=None,
+                        help="a JSON or text file of words (default: the --top words of model1)")
+    parser.add_argument("--top", type=int, default=10000)
+    parser.add_argument("--topn", type=int, default=10)
+    parser.add_argument("--blocksize", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--samplesize", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--solver", default="lstsq")
+    args = parser.parse_args(argv)
+    configure_logging(level="INFO")
+    collection = ModelCollection(args.models_dir)
+    alignment = Alignment(args.model1, args.model2, collection=collection,
+                          samplesize=args.samplesize, seed=args.seed,
+                          store=AlignmentStore(args.alignment_dir), solver=args.solver)
+    words = read_words(args.words) if args.words else args.top
+    return alignment.precompute(words, topn=args.topn, blocksize=args.blocksize,
+                                workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
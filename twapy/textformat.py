@@ -0,0 +1,203 @@
+"""A fast reader for word2vec models in the text format.
+
+Gensim parses word2vec text files one line at a time in Python, which is slow for large models.
+`read_text_vectors` instead reads the file in large chunks of bytes that end on a line boundary,
+and decodes all of the vectors of a chunk with a single call to numpy's C parser. With more than
+one worker, the chunks are parsed in a pool of processes while the next chunks are read. The
+vectors are written straight into a float32 matrix that is allocated once, from the header of the
+file, or into a memory-mapped `.npy` file when converting a model to the native format:
+
+>>> from twapy.textformat import read_text_vectors
+>>> index2word, syn0 = read_text_vectors('/path/to/models/1987.txt')
+>>> index2word, syn0 = read_text_vectors('/path/to/models/1987.txt.gz', output='1987.npy')
+
+Files ending in `.gz` are decompressed as they are read, without a copy of the decompressed file
+on disk. Files without a `count dimension` header line (such as GloVe files) are also accepted.
+
+"""
+
+import gzip
+import os
+from collections import deque
+
+import numpy as np
+
+from . import debug
+
+
+# The number of bytes read (and parsed) at a time, and the number of processes that parse them
+# (by default, the number of CPUs).
+TEXT_CHUNKSIZE = 1 << 25
+TEXT_WORKERS = None
+
+
+def open_text(filename):
+    """Open a word2vec text file for reading bytes, decompressing it on the fly if it ends in
+    `.gz`."""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def read_header(f):
+    """Read the header of a word2vec text file.
+
+    ::returns:: a tuple `(count, dim, pending)`, where `pending` is the first line of the vectors
+        if the file has no header, in which case `count` is None and `dim` is taken from that line.
+    """
+    first = f.readline()
+    fields = first.split()
+    if len(fields) == 2:
+        try:
+            return int(fields[0]), int(fields[1]), b""
+        except ValueError:
+            pass
+    if len(fields) < 2:
+        raise ValueError("Cannot read the header of the word2vec text file")
+    return None, len(fields) - 1, first
+
+
+def read_text_vectors(filename, limit=None, chunksize=None, workers=None, output=None,
+                      unicode_errors="strict"):
+    """Read the words and vectors of a word2vec model in the text format.
+
+    ::param limit:: if given, only the first `limit` words are read
+    ::param chunksize:: the number of bytes read at a time (by default, `TEXT_CHUNKSIZE`)
+    ::param workers:: the number of processes that parse the chunks (by default, `TEXT_WORKERS`,
+        or the number of CPUs). Small files are always parsed in this process.
+    ::param output:: if given, the vectors are written to this `.npy` file, which is returned
+        memory-mapped
+    ::param unicode_errors:: how to handle words that are not valid UTF-8 (see `bytes.decode`)
+    ::returns:: a tuple `(index2word, syn0)` of the list of words and the float32 matrix of vectors
+    """
+    chunksize = chunksize or TEXT_CHUNKSIZE
+    workers = workers or TEXT_WORKERS or os.cpu_count() or 1
+    if workers > 1 and os.path.getsize(filename) <= chunksize:
+        workers = 1
+    with open_text(filename) as f:
+        count, dim, pending = read_header(f)
+        if limit is not None:
+            count = limit if count is None else min(count, limit)
+        debug("Reading {:} vectors of dimension {:} from {:} with {:} workers",
+              "all" if count is None else "{:,}".format(count), dim, filename, workers)
+        if count is None:
+            # Without a header, the number of rows is only known at the end.
+            syn0 = None
+            blocks = []
+        elif output is not None:
+            syn0 = np.lib.format.open_memmap(output, mode="w+", dtype=np.float32,
+                                             shape=(count, dim))
+        else:
+            syn0 = np.empty((count, dim), dtype=np.float32)
+        index2word = []
+        row = 0
+        for words, vectors in _parse_chunks(_read_chunks(f, chunksize, pending), dim, workers,
+                                            unicode_errors):
+            if count is not None:
+                words, vectors = words[:count - row], vectors[:count - row]
+                syn0[row:row + len(words)] = vectors
+            else:
+                blocks.append(vectors)
+            index2word.extend(words)
+            row += len(words)
+            if count is not None and row >= count:
+                break
+    if syn0 is None:
+        syn0 = np.concatenate(blocks) if blocks else np.empty((0, dim), dtype=np.float32)
+        if output is not None:
+            np.save(output, syn0)
+            syn0 = np.load(output, mmap_mode="r")
+    elif row < count:
+        raise ValueError("Unexpected end of {:}: expected {:,} vectors but read {:,}"
+                         .format(filename, count, row))
+    if output is not None:
+        syn0.flush()
+    return index2word, syn0
+
+
+def _read_chunks(f, chunksize, pending=b""):
+    """Yield the contents of the file `f` in chunks of about `chunksize` bytes that end on a line
+    boundary, starting with the bytes `pending`."""
+    while True:
+        block = f.read(chunksize)
+        if not block:
+            break
+        block = pending + block
+        end = block.rfind(b"\n") + 1
+        if end == 0:
+            pending = block
+            continue
+        pending = block[end:]
+        yield block[:end]
+    if pending.strip():
+        yield pending
+
+
+def _parse_chunks(chunks, dim, workers, unicode_errors):
+    """Parse `chunks` with `parse_chunk`, in order, in a pool of `workers` processes if there is
+    more than one."""
+    if workers <= 1:
+        for chunk in chunks:
+            yield parse_chunk(chunk, dim, unicode_errors)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    # Only keep a few chunks in flight, so that the file is not read faster than it is parsed.
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = deque()
+        try:
+            for chunk in chunks:
+                futures.append(executor.submit(parse_chunk, chunk, dim, unicode_errors))
+                if len(futures) >= 2 * workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def parse_chunk(chunk, dim, unicode_errors="strict"):
+    """Parse the lines of a chunk of a word2vec text file.
+
+    The word of each line is split off, and the values of all of the lines are decoded at once.
+
+    ::returns:: a tuple `(words, vectors)` of the list of words and a `(len(words), dim)` float32
+        matrix
+    """
+    words = []
+    values = []
+    for line in chunk.split(b"\n"):
+        word, _, rest = line.partition(b" ")
+        if not word.strip():
+            continue
+        words.append(word)
+        values.append(rest)
+    try:
+        vectors = np.fromstring(b" ".join(values), dtype=np.float32, sep=" ")
+    except ValueError:
+        # Recent versions of numpy raise on a value that is not a number (older versions stop
+        # parsing there, which gives too few values).
+        vectors = None
+    if vectors is None or vectors.shape[0] != len(words) * dim:
+        _check_lines(words, values, dim)
+        raise ValueError("Cannot parse the vectors of the words from '{:}' to '{:}'".format(
+            words[0].decode("utf-8", "replace"), words[-1].decode("utf-8", "replace")))
+    words = [word.decode("utf-8", unicode_errors) for word in words]
+    return words, vectors.reshape(len(words), dim)
+
+
+def _check_lines(words, values, dim):
+    """Raise a ValueError that names the first word whose values cannot be parsed."""
+    for word, rest in zip(words, values):
+        word = word.decode("utf-8", "replace")
+        tokens = rest.split()
+        if len(tokens) != dim:
+            raise ValueError("The vector of '{:}' has {:} values instead of {:}".format(
+                word, len(tokens), dim))
+        for token in tokens:
+            try:
+                float(token)
+            except ValueError:
+                raise ValueError("The vector of '{:}' has a value that is not a number: '{:}'"
+                                 .format(word, token.decode("utf-8", "replace")))
+    return